@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+dbt_run_profiler.py
+
+Profiles a finished `dbt run` from the artifacts it leaves in target/.
+
+1) Reads run_results.json and manifest.json.
+2) Appends per-model execution time, rows and bytes processed to a
+   local CSV history store (one row per model per invocation).
+3) Reports the slowest models, regressions against a baseline built
+   from earlier runs, and the critical path through the model lineage.
+
+Run it right after `dbt run`. To try it offline, point DBT_TARGET_DIR
+at fixtures/dbt_target (or fixtures/dbt_target_baseline first, to
+seed the history).
+"""
+
+import os
+import csv
+import json
+import logging
+import statistics
+
+# ─── CONFIG ────────────────────────────────────────────────────────────────────
+PROJECT_ROOT   = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TARGET_DIR     = os.getenv("DBT_TARGET_DIR", os.path.join(PROJECT_ROOT, "target"))
+HISTORY_PATH   = os.getenv("DBT_PROFILE_HISTORY", os.path.join(PROJECT_ROOT, "dbt_run_history.csv"))
+TOP_N          = int(os.getenv("DBT_PROFILE_TOP_N", "5"))
+BASELINE_RUNS  = int(os.getenv("DBT_PROFILE_BASELINE_RUNS", "5"))    # earlier runs in the median
+REGRESSION_PCT = float(os.getenv("DBT_PROFILE_REGRESSION_PCT", "25"))  # % slower / bigger than baseline
+MIN_DELTA_SEC  = float(os.getenv("DBT_PROFILE_MIN_DELTA_SEC", "2"))    # ignore tiny absolute changes
+
+HISTORY_FIELDS = [
+    "invocation_id", "generated_at", "unique_id", "model", "materialized",
+    "status", "execution_time", "rows_affected", "bytes_processed",
+    "bytes_billed", "slot_ms",
+]
+NUMERIC_FIELDS = ["execution_time", "rows_affected", "bytes_processed", "bytes_billed", "slot_ms"]
+
+# ─── LOGGING SETUP ─────────────────────────────────────────────────────────────
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def load_artifacts(target_dir: str):
+    with open(os.path.join(target_dir, "run_results.json"), encoding="utf-8") as f:
+        run_results = json.load(f)
+    with open(os.path.join(target_dir, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    return run_results, manifest
+
+
+def extract_model_stats(run_results: dict, manifest: dict) -> list:
+    """One history row per model result in `run_results`."""
+    meta  = run_results.get("metadata", {})
+    nodes = manifest.get("nodes", {})
+    rows = []
+    for res in run_results.get("results", []):
+        uid = res["unique_id"]
+        if not uid.startswith("model."):
+            continue
+        node    = nodes.get(uid, {})
+        adapter = res.get("adapter_response") or {}
+        rows.append({
+            "invocation_id":   meta.get("invocation_id", ""),
+            "generated_at":    meta.get("generated_at", ""),
+            "unique_id":       uid,
+            "model":           node.get("name", uid.split(".")[-1]),
+            "materialized":    node.get("config", {}).get("materialized", ""),
+            "status":          res.get("status", ""),
+            "execution_time":  float(res.get("execution_time") or 0.0),
+            "rows_affected":   int(adapter.get("rows_affected") or 0),
+            "bytes_processed": int(adapter.get("bytes_processed") or 0),
+            "bytes_billed":    int(adapter.get("bytes_billed") or 0),
+            "slot_ms":         int(adapter.get("slot_ms") or 0),
+        })
+    return rows
+
+
+def read_history(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        for field in NUMERIC_FIELDS:
+            row[field] = float(row[field] or 0)
+    return rows
+
+
+def append_history(rows: list, path: str, history: list) -> int:
+    """Append `rows` unless their invocation is already stored; returns rows written."""
+    seen = {h["invocation_id"] for h in history}
+    rows = [r for r in rows if r["invocation_id"] not in seen]
+    if not rows:
+        return 0
+    new_file = not os.path.exists(path)
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=HISTORY_FIELDS)
+        if new_file:
+            writer.writeheader()
+        writer.writerows(rows)
+    return len(rows)
+
+
+def slowest_models(rows: list, n: int = TOP_N) -> list:
+    return sorted(rows, key=lambda r: r["execution_time"], reverse=True)[:n]
+
+
+def baselines(history: list, current_invocation: str, runs: int = BASELINE_RUNS) -> dict:
+    """Median time and bytes per model over its last `runs` earlier invocations."""
+    per_model = {}
+    for row in history:
+        if row["invocation_id"] == current_invocation or row["status"] != "success":
+            continue
+        per_model.setdefault(row["unique_id"], []).append(row)
+    out = {}
+    for uid, rows in per_model.items():
+        rows = sorted(rows, key=lambda r: r["generated_at"])[-runs:]
+        out[uid] = {
+            "runs":            len(rows),
+            "execution_time":  statistics.median(r["execution_time"] for r in rows),
+            "bytes_processed": statistics.median(r["bytes_processed"] for r in rows),
+        }
+    return out
+
+
+def find_regressions(rows: list, baseline: dict,
+                     pct: float = REGRESSION_PCT, min_delta: float = MIN_DELTA_SEC) -> list:
+    """Models whose time or bytes grew more than `pct` % over their baseline."""
+    factor = 1 + pct / 100
+    regressions = []
+    for row in rows:
+        base = baseline.get(row["unique_id"])
+        if not base:
+            continue
+        slower = (row["execution_time"] > base["execution_time"] * factor
+                  and row["execution_time"] - base["execution_time"] >= min_delta)
+        bigger = (base["bytes_processed"] > 0
+                  and row["bytes_processed"] > base["bytes_processed"] * factor)
+        if slower or bigger:
+            regressions.append({**row, "baseline": base, "slower": slower, "bigger": bigger})
+    return regressions
+
+
+def critical_path(rows: list, manifest: dict):
+    """
+    Longest chain of executed models, weighted by execution time.
+
+    Edges come from each node's depends_on in the manifest; dependencies
+    that were not part of this run (sources, seeds, skipped models)
+    contribute no time.
+    """
+    times = {r["unique_id"]: r["execution_time"] for r in rows}
+    nodes = manifest.get("nodes", {})
+    parents = {
+        uid: [p for p in nodes.get(uid, {}).get("depends_on", {}).get("nodes", []) if p in times]
+        for uid in times
+    }
+
+    finish, best_parent = {}, {}
+
+    def visit(uid):
+        if uid in finish:
+            return finish[uid]
+        finish[uid] = 0.0  # guards against cycles in a malformed manifest
+        prev = max(parents[uid], key=visit, default=None)
+        best_parent[uid] = prev
+        finish[uid] = (finish[prev] if prev else 0.0) + times[uid]
+        return finish[uid]
+
+    for uid in times:
+        visit(uid)
+    if not finish:
+        return [], 0.0
+
+    end = max(finish, key=finish.get)
+    path = []
+    while end:
+        path.append(end)
+        end = best_parent[end]
+    path.reverse()
+    return path, finish[path[-1]]
+
+
+def fmt_bytes(n: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if n < 1024 or unit == "TiB":
+            return f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def format_report(rows: list, regressions: list, path: list, path_time: float) -> str:
+    names = {r["unique_id"]: r["model"] for r in rows}
+    total_time  = sum(r["execution_time"] for r in rows)
+    total_bytes = sum(r["bytes_processed"] for r in rows)
+    lines = [f"{len(rows)} models, {total_time:.1f}s summed, {fmt_bytes(total_bytes)} processed", ""]
+
+    lines.append(f"Slowest {TOP_N} models:")
+    for r in slowest_models(rows):
+        lines.append(
+            f"  {r['model']:<28} {r['execution_time']:>8.1f}s  {fmt_bytes(r['bytes_processed']):>11}"
+            f"  {r['rows_affected']:>10} rows  ({r['materialized']}, {r['status']})"
+        )
+
+    lines += ["", "Regressions vs baseline:"]
+    if not regressions:
+        lines.append("  none")
+    for r in regressions:
+        base = r["baseline"]
+        what = []
+        if r["slower"]:
+            what.append(f"time {base['execution_time']:.1f}s -> {r['execution_time']:.1f}s")
+        if r["bigger"]:
+            what.append(f"bytes {fmt_bytes(base['bytes_processed'])} -> {fmt_bytes(r['bytes_processed'])}")
+        lines.append(f"  {r['model']:<28} {'; '.join(what)}  (median of {base['runs']} runs)")
+
+    lines += ["", f"Critical path ({path_time:.1f}s of {total_time:.1f}s):"]
+    lines.append("  " + " -> ".join(names[uid] for uid in path) if path else "  none")
+    return "\n".join(lines)
+
+
+def main():
+    logger.info(f"Reading dbt artifacts from {TARGET_DIR}")
+    run_results, manifest = load_artifacts(TARGET_DIR)
+    rows = extract_model_stats(run_results, manifest)
+    if not rows:
+        logger.info("No model results in run_results.json; nothing to profile.")
+        return
+
+    history = read_history(HISTORY_PATH)
+    written = append_history(rows, HISTORY_PATH, history)
+    logger.info(f"Appended {written} rows to {HISTORY_PATH}.")
+
+    baseline = baselines(history, rows[0]["invocation_id"])
+    regressions = find_regressions(rows, baseline)
+    path, path_time = critical_path(rows, manifest)
+    print(format_report(rows, regressions, path, path_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,12 +7,28 @@ fetch_schedule_weather.py
 3) Only processes matches whose datetime ≤ today.
 4) Batches by season to pace API calls.
 5) Fetches hourly weather via Open-Meteo with retry/backoff.
-6) Deletes and rewrites the enriched CSV in GCS with a fixed column order.
+6) Checkpoints newly enriched rows to GCS every few matches, and stops
+   cleanly once the per-run time or API request budget is spent; the
+   next run resumes from the checkpoint and picks up the remainder.
+   Matches that fail (every retry, or the hour missing) are recorded in
+   a failures file: later runs try them after fresh matches, and after
+   MAX_MATCH_ATTEMPTS failed runs only once every RETRY_PARKED_DAYS.
+7) Appends the new rows to the enriched CSV in GCS with a fixed column
+   order, writing only if the object is unchanged since it was read.
+
+Overlapping runs coalesce through a lease object (see gcs_lease.py):
+each run claims up to SLICE_SIZE pending matches that no live run holds
+and enriches only those. With COALESCE_MODE=exit a run that finds
+another live run exits immediately instead.
+
+Frames are held with the typed layout from schedule_schema.py.
+Set PROFILE=1 to write a CPU/allocation profile (see profiling_hooks.py).
 """
 
 import os
-import io
+import json
 import time
+import uuid
 import datetime
 import requests
 import pandas as pd
@@ -20,11 +36,18 @@ import pandas as pd
 from google.oauth2 import service_account
 from google.cloud import storage
 
+import gcs_lease
+import schedule_schema
+import profiling_hooks
+
 # ─── CONFIG ────────────────────────────────────────────────────────────────────
 PROJECT_ID    = "data-management-2-manoj"
 BUCKET_NAME   = "cricket_analytics_src"
 SCHEDULE_PATH = "schedule/ipl_full_schedule.csv"
 OUTPUT_PATH   = "schedule/ipl_full_schedule_with_weather.csv"
+CHECKPOINT_PATH = "schedule/ipl_full_schedule_with_weather.checkpoint.csv"
+LEASE_PATH    = "schedule/ipl_full_schedule_with_weather.lease.json"
+FAILURES_PATH = "schedule/ipl_full_schedule_with_weather.failures.json"
 KEY_PATH      = os.path.join(
     os.path.dirname(__file__),
     "data-management-2-manoj-67d7f9a199ea.json"
@@ -42,6 +65,21 @@ TIMEZONE    = "Asia/Kolkata"
 PAUSE_SEC   = 1.0
 MAX_RETRIES = 3  # number of fetch retries
 
+# per-run budget: stop fetching before the function deadline / API quota
+RUN_BUDGET_SEC   = float(os.getenv("RUN_BUDGET_SEC", "480"))   # function timeout minus headroom
+FLUSH_MARGIN_SEC = float(os.getenv("FLUSH_MARGIN_SEC", "30"))  # reserved for the final upload
+MAX_API_CALLS    = int(os.getenv("MAX_API_CALLS", "500"))      # includes retries
+CHECKPOINT_EVERY = int(os.getenv("CHECKPOINT_EVERY", "20"))    # enriched rows between checkpoints
+
+# concurrent runs: "slice" takes unclaimed matches, "exit" leaves it to the live run
+COALESCE_MODE = os.getenv("COALESCE_MODE", "slice")
+SLICE_SIZE    = int(os.getenv("SLICE_SIZE", str(MAX_API_CALLS)))  # matches claimed per run
+LEASE_TTL_SEC = float(os.getenv("LEASE_TTL_SEC", str(RUN_BUDGET_SEC + 60)))  # claim outlives the run
+
+# matches that fail (all retries, or the hour missing) are retried after fresh ones
+MAX_MATCH_ATTEMPTS = int(os.getenv("MAX_MATCH_ATTEMPTS", "3"))    # failed runs before a match is parked
+RETRY_PARKED_DAYS  = float(os.getenv("RETRY_PARKED_DAYS", "7"))   # parked matches get one try per period
+
 # ─── GCS CLIENT SETUP ──────────────────────────────────────────────────────────
 creds  = service_account.Credentials.from_service_account_file(KEY_PATH)
 client = storage.Client(project=PROJECT_ID, credentials=creds)
@@ -63,11 +101,35 @@ def fetch_hourly_archive(lat, lon, date_iso, vars_list, timezone):
     return resp.json()
 
 
-def safe_fetch(lat, lon, date_iso, vars_list, timezone):
+def new_budget():
+    return {"started": time.monotonic(), "api_calls": 0, "quota_hit": False}
+
+
+def budget_exhausted(budget):
+    """Reason the run must stop fetching, or None while budget remains."""
+    elapsed = time.monotonic() - budget["started"]
+    if budget["quota_hit"]:
+        return "API quota exhausted (HTTP 429)"
+    if elapsed >= RUN_BUDGET_SEC - FLUSH_MARGIN_SEC:
+        return f"time budget reached after {elapsed:.0f}s"
+    if budget["api_calls"] >= MAX_API_CALLS:
+        return f"request budget reached after {budget['api_calls']} API calls"
+    return None
+
+
+def safe_fetch(lat, lon, date_iso, vars_list, timezone, budget):
     for attempt in range(1, MAX_RETRIES+1):
+        if budget_exhausted(budget):
+            return None
+        budget["api_calls"] += 1
         try:
             return fetch_hourly_archive(lat, lon, date_iso, vars_list, timezone)
         except requests.exceptions.RequestException as e:
+            status = getattr(e.response, "status_code", None)
+            if status == 429:
+                print(f" ❌ Rate limited by the weather API: {e}.")
+                budget["quota_hit"] = True
+                return None
             if attempt < MAX_RETRIES:
                 wait = 2 ** (attempt - 1)
                 print(f" ⚠️ Fetch attempt {attempt} failed: {e}. Retrying in {wait}s...")
@@ -77,88 +139,189 @@ def safe_fetch(lat, lon, date_iso, vars_list, timezone):
                 return None
 
 
-def parse_dt(date_str, time_str):
-    # date_str="DD/MM/YYYY", time_str="HH:MM"
-    return datetime.datetime.strptime(f"{date_str} {time_str}", "%d/%m/%Y %H:%M")
-
-
-def download_csv_from_gcs(blob_path):
+def download_csv_from_gcs(blob_path, columns):
     blob = bucket.blob(blob_path)
     if not blob.exists(client):
         return None
-    data = blob.download_as_string()
-    return pd.read_csv(io.StringIO(data.decode("utf-8")))
+    data = blob.download_as_bytes()
+    return schedule_schema.read_frame(data, columns)
 
 
-def upload_df_to_gcs(df, blob_path):
-    blob = bucket.blob(blob_path)
-    # delete old file to avoid overwrite issues
-    if blob.exists(client):
-        print(f"ℹ️ Deleting existing blob: {blob_path}")
-        blob.delete(client)
-    csv_bytes = df.to_csv(index=False).encode("utf-8")
-    blob.upload_from_string(csv_bytes, content_type="text/csv")
+def merge_rows_to_gcs(df_rows, blob_path):
+    """
+    Append `df_rows` whose match_id is not yet in the CSV at `blob_path`.
+    Only the match_id column of the existing file is parsed; its rows stay
+    as bytes. The write is conditional on the generation read, so rows
+    merged by a concurrent run are kept. Returns the match_ids now stored.
+    """
+    stored = []
+
+    def update(data):
+        ids = (schedule_schema.read_frame(data, ["match_id"])["match_id"]
+               if data else pd.Series(dtype="Int64"))
+        df_add = df_rows[~df_rows["match_id"].isin(ids)]
+        stored[:] = [pd.concat([ids, df_add["match_id"]], ignore_index=True)]
+        return schedule_schema.append_csv_bytes(data, df_add) if len(df_add) else data
+
+    gcs_lease.cas_update(bucket, blob_path, update, "text/csv")
+    return stored[0]
+
+
+def save_checkpoint(records):
+    """Merge this run's enriched rows into the shared checkpoint."""
+    ids = merge_rows_to_gcs(
+        pd.DataFrame(records, columns=schedule_schema.ENRICHED_COLS), CHECKPOINT_PATH)
+    print(f"💾 Checkpointed {len(ids)} pending rows.")
 
 
-def main():
+def prune_checkpoint(done_ids):
+    """Drop checkpointed rows that reached the output; delete the checkpoint once empty."""
+    def update(data):
+        if not data:
+            return data
+        df = schedule_schema.read_frame(data, schedule_schema.ENRICHED_COLS)
+        keep = ~df["match_id"].isin(done_ids)
+        if keep.all():
+            return data
+        return schedule_schema.to_csv_bytes(df[keep]) if keep.any() else None
+
+    gcs_lease.cas_update(bucket, CHECKPOINT_PATH, update, "text/csv")
+
+
+def load_failures():
+    """{match_id: {"attempts": failed runs, "last_failed": epoch}} from earlier runs."""
+    data, _ = gcs_lease.read_blob(bucket, FAILURES_PATH)
+    return {int(k): v for k, v in json.loads(data).items()} if data else {}
+
+
+def record_failures(failed_ids, stored_ids):
+    """Count one more failed run for `failed_ids`; forget matches now stored."""
+    def update(data):
+        failures = json.loads(data) if data else {}
+        for mid in failed_ids:
+            entry = failures.setdefault(str(mid), {"attempts": 0})
+            entry["attempts"] += 1
+            entry["last_failed"] = time.time()
+        for mid in stored_ids:
+            failures.pop(str(mid), None)
+        return json.dumps(failures).encode("utf-8") if failures else None
+
+    gcs_lease.cas_update(bucket, FAILURES_PATH, update, "application/json")
+
+
+def stored_match_ids():
+    """match_ids already in the output or the checkpoint, read fresh from GCS."""
+    frames = [download_csv_from_gcs(path, ["match_id"]) for path in (OUTPUT_PATH, CHECKPOINT_PATH)]
+    ids = [df["match_id"] for df in frames if df is not None]
+    return pd.concat(ids, ignore_index=True) if ids else pd.Series(dtype="Int64")
+
+
+def main() -> int:
+    """Enrich new past matches with weather; returns the number of rows added."""
+    budget = new_budget()
+
     # 1) Download schedule
     print(f"⏳ Downloading schedule from gs://{BUCKET_NAME}/{SCHEDULE_PATH}")
-    df_sched = download_csv_from_gcs(SCHEDULE_PATH)
+    df_sched = download_csv_from_gcs(SCHEDULE_PATH, schedule_schema.SCHEDULE_COLS)
     if df_sched is None:
         raise SystemExit("❌ Schedule file not found in GCS.")
     print(f"✔️ Loaded {len(df_sched)} matches.")
 
     # 2) Load existing enriched
-    df_old = download_csv_from_gcs(OUTPUT_PATH)
+    df_old = download_csv_from_gcs(OUTPUT_PATH, ["match_id"])  # only the IDs are needed
     if df_old is None:
         print("ℹ️ No enriched file exists: starting fresh.")
-        df_old = pd.DataFrame(columns=[
-            "season","match_id","city","match_num","venue",
-            "match_date","match_time","team1","team2","venue_id",
-            "latitude","longitude","datetime","temp_C","humidity_%",
-            "pressure_hPa","cloudcover_%","rain_mm","wind_m_s"
-        ])
+        df_old = schedule_schema.empty_frame()
     else:
         print(f"ℹ️ Found {len(df_old)} enriched rows.")
 
+    # Resume: rows enriched by an interrupted run count as done
+    df_ckpt = download_csv_from_gcs(CHECKPOINT_PATH, schedule_schema.ENRICHED_COLS)
+    if df_ckpt is None:
+        df_ckpt = schedule_schema.empty_frame()
+    else:
+        df_ckpt = df_ckpt[~df_ckpt["match_id"].isin(df_old["match_id"])]
+        print(f"ℹ️ Resuming with {len(df_ckpt)} checkpointed rows.")
+
     # 3) Filter past-or-today matches
     now = datetime.datetime.now()
-    df_sched["dt_obj"] = df_sched.apply(
-        lambda r: parse_dt(r["match_date"], r["match_time"]), axis=1)
-    df_past = df_sched[df_sched["dt_obj"] <= now].copy()
+    df_sched["dt_obj"] = schedule_schema.match_datetimes(df_sched)
+    df_past = df_sched[df_sched["dt_obj"] <= now]
     print(f"✔️ {len(df_past)} matches ≤ today.")
 
     # 4) Skip already fetched
-    done_ids = set(df_old["match_id"].astype(str))
-    df_new = df_past[~df_past["match_id"].astype(str).isin(done_ids)].copy()
-    print(f"✔️ {len(df_new)} new matches to enrich.")
-    if df_new.empty:
+    done = df_past["match_id"].isin(df_old["match_id"]) | df_past["match_id"].isin(df_ckpt["match_id"])
+    df_new = df_past[~done]
+
+    # Matches that failed earlier runs go after fresh ones; after
+    # MAX_MATCH_ATTEMPTS failed runs they wait RETRY_PARKED_DAYS between tries
+    failures = load_failures()
+    attempts = df_new["match_id"].map(lambda m: failures.get(int(m), {}).get("attempts", 0)).astype(int)
+    last_failed = df_new["match_id"].map(lambda m: failures.get(int(m), {}).get("last_failed", 0.0))
+    parked = ((attempts >= MAX_MATCH_ATTEMPTS)
+              & (time.time() - last_failed.astype(float) < RETRY_PARKED_DAYS * 86400))
+    df_new = df_new.assign(attempts=attempts)[~parked].sort_values("attempts", kind="stable")
+    if parked.any():
+        print(f"ℹ️ {parked.sum()} matches failed {MAX_MATCH_ATTEMPTS}+ runs; parked until their retry date.")
+    print(f"✔️ {len(df_new)} new matches to enrich ({(df_new['attempts'] > 0).sum()} retries).")
+    if df_new.empty and df_ckpt.empty:
         print("✅ Nothing new to fetch; exiting.")
-        return
+        return 0
 
-    # 5) Batch by season
-    records = []
-    for season, grp in df_new.groupby("season"):
-        print(f"\n--- Season {season} ({len(grp)} matches) ---")
+    # Claim a slice no concurrent run is working on
+    run_id = uuid.uuid4().hex
+    pending = [int(m) for m in df_new["match_id"]]
+    claimed = gcs_lease.claim_slice(bucket, LEASE_PATH, run_id, pending, SLICE_SIZE,
+                                    LEASE_TTL_SEC, exclusive=COALESCE_MODE == "exit")
+    if pending and not claimed:
+        print("✅ Another run holds every pending match; exiting.")
+        return 0
+    # Re-read after claiming: a run that released its claim just before
+    # ours has already stored its matches
+    df_new = df_new[df_new["match_id"].isin(claimed)]
+    finished = df_new["match_id"].isin(stored_match_ids())
+    if finished.any():
+        print(f"ℹ️ {finished.sum()} claimed matches were stored by another run meanwhile.")
+    df_new = df_new[~finished]
+    print(f"🔒 Claimed {len(df_new)} matches as run {run_id[:8]}.")
+    try:
+        return enrich_and_upload(df_sched, df_ckpt, df_new, budget)
+    finally:
+        gcs_lease.release(bucket, LEASE_PATH, run_id)
+
+
+def enrich_and_upload(df_sched, df_ckpt, df_new, budget) -> int:
+    # 5) Batch by season, within the run budget
+    records, failed = [], []
+    stop_reason = None
+    for (tries, season), grp in df_new.groupby(["attempts", "season"], observed=True):
+        retry = f", failed {tries} earlier runs" if tries else ""
+        print(f"\n--- Season {season} ({len(grp)} matches{retry}) ---")
         for _, row in grp.iterrows():
+            stop_reason = budget_exhausted(budget)
+            if stop_reason:
+                break
             dt = row["dt_obj"]
             iso_dt = dt.strftime("%Y-%m-%dT%H:00")
             date_iso = dt.date().isoformat()
             lat, lon = row["latitude"], row["longitude"]
 
             print(f"Fetching match {row['match_id']} @ {iso_dt}…", end="")
-            data = safe_fetch(lat, lon, date_iso, HOURLY_VARS, TIMEZONE)
+            data = safe_fetch(lat, lon, date_iso, HOURLY_VARS, TIMEZONE, budget)
             if not data:
                 print(" skipped.")
+                if not budget_exhausted(budget):  # not a budget stop: the match itself failed
+                    failed.append(int(row["match_id"]))
                 continue
 
             times = data.get("hourly", {}).get("time", [])
             if iso_dt not in times:
                 print(" ⚠️ missing hour, skipped.")
+                failed.append(int(row["match_id"]))
                 continue
 
             idx = times.index(iso_dt)
-            rec = row.drop(["dt_obj"]).to_dict()
+            rec = row.drop(["dt_obj", "attempts"]).to_dict()
             rec.update({
                 "datetime":     iso_dt,
                 "temp_C":       data["hourly"]["temperature_2m"][idx],
@@ -170,28 +333,34 @@ def main():
             })
             records.append(rec)
             print(" done.")
+            if len(records) % CHECKPOINT_EVERY == 0:
+                save_checkpoint(records)
             time.sleep(PAUSE_SEC)
+        if stop_reason:
+            break
+
+    if stop_reason:
+        print(f"\n⏸️ Stopping early: {stop_reason}; remaining matches carry over to the next run.")
 
     # 6) Combine and enforce order
-    df_new_enriched = pd.DataFrame(records)
-    print(f"\n✔️ Fetched weather for {len(df_new_enriched)} matches.")
-
-    df_combined = pd.concat([df_old, df_new_enriched], ignore_index=True)
-    schedule_cols = [
-        "season","match_id","city","match_num","venue",
-        "match_date","match_time","team1","team2","venue_id",
-        "latitude","longitude"
-    ]
-    weather_cols = [
-        "datetime","temp_C","humidity_%","pressure_hPa",
-        "cloudcover_%","rain_mm","wind_m_s"
-    ]
-    df_combined = df_combined[schedule_cols + weather_cols]
-
-    # 7) Upload
-    print(f"⏳ Uploading {len(df_combined)} rows to gs://{BUCKET_NAME}/{OUTPUT_PATH}")
-    upload_df_to_gcs(df_combined, OUTPUT_PATH)
-    print(f"✅ Done.")
+    df_new_enriched = schedule_schema.append(
+        df_ckpt, pd.DataFrame(records, columns=schedule_schema.ENRICHED_COLS))
+    print(f"\n✔️ Fetched weather for {len(records)} matches "
+          f"({budget['api_calls']} API calls, {len(df_ckpt)} resumed from checkpoint).")
+
+    # 7) Merge into the output, then drop what landed from the checkpoint
+    print(f"⏳ Merging {len(df_new_enriched)} rows into gs://{BUCKET_NAME}/{OUTPUT_PATH}")
+    stored_ids = merge_rows_to_gcs(df_new_enriched, OUTPUT_PATH)
+    print(schedule_schema.memory_report({
+        "schedule": df_sched, "new enriched": df_new_enriched,
+    }))
+    prune_checkpoint(stored_ids)
+    record_failures(failed, stored_ids)
+    if failed:
+        print(f"⚠️ {len(failed)} matches failed; they are retried after fresh ones.")
+    print(f"✅ Done: {len(stored_ids)} enriched rows.")
+    return len(df_new_enriched)
 
 if __name__ == "__main__":
-    main()
+    with profiling_hooks.profile("fetch_schedule_weather"):
+        main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+gcs_lease.py
+
+Generation-checked writes and a small lease for GCS objects, so that
+overlapping runs of the weather enrichment neither repeat each other's
+work nor overwrite each other's output.
+
+1) cas_update() reads an object with its generation, applies an update
+   function and writes back with if_generation_match, retrying on
+   conflict.
+2) The lease object records, per run, the match IDs it has claimed and
+   when the claim expires. claim_slice() takes up to `limit` pending
+   matches that no live run holds (or nothing at all when `exclusive`
+   and another run is live); release() drops the run's claim.
+"""
+
+import json
+import time
+import random
+import logging
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+CAS_RETRIES = 8
+
+logger = logging.getLogger(__name__)
+
+
+def read_blob(bucket, path):
+    """(bytes, generation) of the object, or (None, 0) when it does not exist."""
+    blob = bucket.get_blob(path)
+    if blob is None:
+        return None, 0
+    return blob.download_as_bytes(if_generation_match=blob.generation), blob.generation
+
+
+def cas_update(bucket, path, update, content_type, retries=CAS_RETRIES):
+    """
+    Replace the object at `path` with update(current bytes or None).
+
+    update() returning the bytes it was given leaves the object alone;
+    returning None deletes it. The write only succeeds if nobody changed
+    the object since it was read; otherwise update() runs again on the
+    fresh contents. Returns the bytes that were stored.
+    """
+    for attempt in range(1, retries + 1):
+        try:
+            data, generation = read_blob(bucket, path)
+            new = update(data)
+            if new == data:
+                return data
+            blob = bucket.blob(path)
+            if new is None:
+                blob.delete(if_generation_match=generation)
+            else:
+                blob.upload_from_string(new, content_type=content_type, if_generation_match=generation)
+            return new
+        except (PreconditionFailed, NotFound):
+            wait = random.uniform(0, 0.2 * 2 ** attempt)
+            logger.info(f"Concurrent write to {path} (attempt {attempt}); retrying in {wait:.1f}s")
+            time.sleep(wait)
+    raise RuntimeError(f"Gave up writing {path} after {retries} conflicting updates")
+
+
+def _live_holders(data, now):
+    lease = json.loads(data) if data else {"holders": {}}
+    return {rid: h for rid, h in lease["holders"].items() if h["expires_at"] > now}
+
+
+def claim_slice(bucket, path, run_id, pending_ids, limit, ttl_sec, exclusive=False):
+    """
+    Claim up to `limit` of `pending_ids` for `run_id`; returns the claimed IDs.
+
+    IDs held by another live run are never handed out twice. Claims of
+    runs past their expiry (crashed or timed out) are discarded.
+    """
+    claimed = []
+
+    def update(data):
+        now = time.time()
+        holders = _live_holders(data, now)
+        others = {rid: h for rid, h in holders.items() if rid != run_id}
+        taken = {mid for h in others.values() for mid in h["match_ids"]}
+        if exclusive and others:
+            mine = []
+        else:
+            mine = [mid for mid in pending_ids if mid not in taken][:limit]
+        claimed[:] = mine
+        if not mine:
+            return data
+        holders[run_id] = {"expires_at": now + ttl_sec, "match_ids": mine}
+        return json.dumps({"holders": holders}).encode("utf-8")
+
+    cas_update(bucket, path, update, "application/json")
+    return claimed
+
+
+def release(bucket, path, run_id):
+    """Drop `run_id`'s claim; the lease object is deleted once nobody holds it."""
+    def update(data):
+        if not data:
+            return data
+        holders = _live_holders(data, time.time())
+        holders.pop(run_id, None)
+        return json.dumps({"holders": holders}).encode("utf-8") if holders else None
+
+    cas_update(bucket, path, update, "application/json")
@@ -4,17 +4,34 @@ Cloud Function: raw_json_ingestion_bq
 
 Reads JSON files from GCS and loads new ones into BigQuery with metadata.
 Uses ADC, infers project from environment, adds structured logging.
+
+Large backlogs can be fanned out: in coordinator mode the pending files
+are split into shards and each shard is posted to a worker invocation of
+this same function (WORKER_URL), or run in-process when no URL is set.
+
+In steady state, ingest_json_on_finalize handles object-finalize events
+for the bucket and loads new files in micro-batches, without listing the
+bucket; the HTTP sweep remains for backfills.
 """
 import os
+import sys
 import json
+import time
+import zlib
 import logging
+import threading
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
+import functions_framework
 from flask import Request, make_response
 from google.cloud import storage, bigquery
 from google.api_core.exceptions import NotFound
 
+import profiling_hooks
+import raw_schema
+
 # ─── CONFIG ────────────────────────────────────────────────────────────────────
 # Project is inferred from ADC; explicit PROJECT_ID not required
 DATASET_ID  = os.getenv("BQ_DATASET", "cricket_raw")  # overrideable via env
@@ -22,6 +39,14 @@ TABLE_ID    = os.getenv("BQ_TABLE", "cricket_match_raw")
 BUCKET_NAME = os.getenv("BUCKET_NAME", "cricket_analytics_src")
 PREFIX      = os.getenv("JSON_PREFIX", "")
 BATCH_SIZE  = int(os.getenv("BATCH_SIZE", "75"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "4"))
+SHARD_BY    = os.getenv("SHARD_BY", "hash")           # "hash" or "range"
+WORKER_URL  = os.getenv("WORKER_URL", "")             # this function's URL; empty = in-process
+# keep below the coordinator's own function timeout, or it is killed before
+# a slow worker replies and the aggregated counts are lost
+WORKER_TIMEOUT_SEC = int(os.getenv("WORKER_TIMEOUT_SEC", "480"))
+MICRO_BATCH_SIZE        = int(os.getenv("MICRO_BATCH_SIZE", "25"))
+MICRO_BATCH_MAX_AGE_SEC = float(os.getenv("MICRO_BATCH_MAX_AGE_SEC", "5"))
 
 # ─── LOGGING SETUP ─────────────────────────────────────────────────────────────
 logging.basicConfig(level=logging.INFO)
@@ -37,8 +62,17 @@ def ensure_table(dataset_id: str, table_id: str):
     dataset_ref = bigquery.DatasetReference(project, dataset_id)
     table_ref   = dataset_ref.table(table_id)
     try:
-        bq_client.get_table(table_ref)
+        table = bq_client.get_table(table_ref)
         logger.info(f"BQ table {project}.{dataset_id}.{table_id} exists.")
+        if raw_schema.content_type(table) != raw_schema.CONTENT_TYPE:
+            logger.warning(f"Column content of {project}.{dataset_id}.{table_id} is "
+                           f"{raw_schema.content_type(table)}, not {raw_schema.CONTENT_TYPE}; "
+                           f"run migrate_raw_content_to_json.py.")
+        if table.clustering_fields != raw_schema.CLUSTERING_FIELDS:
+            # applies to data written from now on; BigQuery reclusters in the background
+            table.clustering_fields = raw_schema.CLUSTERING_FIELDS
+            bq_client.update_table(table, ["clustering_fields"])
+            logger.info(f"Clustered {project}.{dataset_id}.{table_id} on {raw_schema.CLUSTERING_FIELDS}.")
     except NotFound:
         logger.info(f"Creating dataset {project}.{dataset_id}")
         try:
@@ -46,13 +80,7 @@ def ensure_table(dataset_id: str, table_id: str):
         except NotFound:
             bq_client.create_dataset(dataset_ref)
             logger.info(f"Created dataset {project}.{dataset_id}.")
-        schema = [
-            bigquery.SchemaField("file_name", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("content", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("file_upload_timestamp", "TIMESTAMP", mode="REQUIRED"),
-        ]
-        table = bigquery.Table(table_ref, schema=schema)
-        bq_client.create_table(table)
+        bq_client.create_table(raw_schema.new_table(table_ref))
         logger.info(f"Created BQ table {project}.{dataset_id}.{table_id}.")
     return table_ref
 
@@ -62,63 +90,312 @@ def chunked(iterable, size):
         yield iterable[i : i + size]
 
 
-def load_json_files_to_bq():
-    # 1) Ensure table
-    table_ref = ensure_table(DATASET_ID, TABLE_ID)
-
-    # 2) Fetch existing file_names
+def list_pending_files() -> list:
+    """Names (prefix stripped) of JSON blobs not yet loaded into BigQuery."""
     project = bq_client.project
     query = f"SELECT file_name FROM `{project}.{DATASET_ID}.{TABLE_ID}`"
     existing = {row.file_name for row in bq_client.query(query).result()}
     logger.info(f"Found {len(existing)} existing files in BQ.")
 
-    # 3) List GCS blobs
     bucket = storage_client.bucket(BUCKET_NAME)
-    blobs  = bucket.list_blobs(prefix=PREFIX)
-    rows = []
-    for blob in blobs:
+    pending = []
+    for blob in bucket.list_blobs(prefix=PREFIX):
         if not blob.name.lower().endswith('.json'):
             continue
         fn = blob.name if not PREFIX else blob.name[len(PREFIX):]
         if fn in existing:
             logger.debug(f"Skipping already-loaded {fn}")
             continue
+        pending.append(fn)
+    return pending
+
+
+def load_files(file_names: list, table_ref=None) -> dict:
+    """
+    Download, validate and insert the given files.
+    Returns counts: files, inserted, errors (failed inserts), invalid (bad JSON).
+    """
+    table_ref = table_ref or ensure_table(DATASET_ID, TABLE_ID)
+    bucket = storage_client.bucket(BUCKET_NAME)
+    rows, invalid = [], 0
+    for fn in file_names:
         logger.info(f"Reading new file: {fn}")
-        raw = blob.download_as_text()
+        raw = bucket.blob(f"{PREFIX}{fn}").download_as_text()
         try:
             json.loads(raw)
         except json.JSONDecodeError as e:
             logger.warning(f"Invalid JSON {fn}: {e}, skipping.")
+            invalid += 1
             continue
         rows.append({
             "file_name": fn,
             "content": raw,
             "file_upload_timestamp": datetime.now(timezone.utc).isoformat().replace('+00:00','Z')
         })
-    if not rows:
-        logger.info("No new JSON files to load.")
-        return
 
-    # 4) Insert in batches
     total, errs = 0, 0
     for i, batch in enumerate(chunked(rows, BATCH_SIZE), start=1):
         logger.info(f"Inserting batch {i} of size {len(batch)}")
-        errors = bq_client.insert_rows_json(table_ref, batch)
+        # file name as insertId: best-effort dedupe of overlapping inserts
+        errors = bq_client.insert_rows_json(table_ref, batch, row_ids=[r["file_name"] for r in batch])
         if errors:
             logger.error(f"Errors in batch {i}: {errors}")
             errs += len(errors)
         else:
             total += len(batch)
     logger.info(f"Insert complete: {total} rows, {errs} errors.")
+    return {"files": len(file_names), "inserted": total, "errors": errs, "invalid": invalid}
+
+
+def load_json_files_to_bq() -> int:
+    """Insert JSON files not yet in BigQuery; returns the number of rows inserted."""
+    table_ref = ensure_table(DATASET_ID, TABLE_ID)
+    pending = list_pending_files()
+    if not pending:
+        logger.info("No new JSON files to load.")
+        return 0
+    return load_files(pending, table_ref)["inserted"]
+
+
+def existing_file_names(file_names: list) -> set:
+    """
+    Which of `file_names` are already in BigQuery. The table is clustered on
+    file_name, so this reads only the blocks that can hold those names.
+    """
+    query = f"""
+        SELECT file_name FROM `{bq_client.project}.{DATASET_ID}.{TABLE_ID}`
+        WHERE file_name IN UNNEST(@names)
+    """
+    config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("names", "STRING", file_names),
+    ])
+    return {row.file_name for row in bq_client.query(query, job_config=config).result()}
+
+
+def load_new_files(file_names: list) -> dict:
+    """
+    load_files() for those of `file_names` not yet in BigQuery, so a retried
+    or overlapping dispatch does not insert them twice. The counts also
+    carry `skipped` (already loaded).
+    """
+    files = list(dict.fromkeys(file_names))
+    loaded = existing_file_names(files) if files else set()
+    to_load = [fn for fn in files if fn not in loaded]
+    if loaded:
+        logger.info(f"Skipping {len(loaded)} of {len(files)} files already in BQ.")
+    res = load_files(to_load) if to_load else {"files": 0, "inserted": 0, "errors": 0, "invalid": 0}
+    res["skipped"] = len(loaded)
+    return res
+
+
+# ─── SHARDED FAN-OUT ───────────────────────────────────────────────────────────
+def shard_files(file_names: list, shards: int, by: str = SHARD_BY) -> list:
+    """Split file names into `shards` lists, by stable hash or by sorted name range."""
+    if by == "range":
+        names = sorted(file_names)
+        size = -(-len(names) // shards)  # ceil
+        return [names[i : i + size] for i in range(0, len(names), size)] if names else []
+    parts = [[] for _ in range(shards)]
+    for fn in file_names:
+        parts[zlib.crc32(fn.encode("utf-8")) % shards].append(fn)
+    return [p for p in parts if p]
+
+
+def dispatch_local(shard: int, file_names: list) -> dict:
+    """In-process worker, used when no WORKER_URL is configured."""
+    return load_new_files(file_names)
+
+
+def dispatch_http(shard: int, file_names: list) -> dict:
+    """Send one shard to a separate invocation of this function."""
+    import requests
+    import google.auth.transport.requests
+    from google.oauth2 import id_token
+
+    token = id_token.fetch_id_token(google.auth.transport.requests.Request(), WORKER_URL)
+    resp = requests.post(
+        WORKER_URL,
+        json={"mode": "worker", "shard": shard, "files": file_names},
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=WORKER_TIMEOUT_SEC,
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+
+def run_coordinator(shards: int = SHARD_COUNT, dispatch=None) -> dict:
+    """
+    List pending files once, fan the shards out to workers in parallel
+    and aggregate their counts. Returns {"shards": [...], "totals": {...}}.
+    """
+    dispatch = dispatch or (dispatch_http if WORKER_URL else dispatch_local)
+    ensure_table(DATASET_ID, TABLE_ID)
+    parts = shard_files(list_pending_files(), max(1, shards))
+    if not parts:
+        logger.info("No new JSON files to load.")
+        return {"shards": [], "totals": {"files": 0, "inserted": 0, "errors": 0, "invalid": 0}}
+    logger.info(f"Dispatching {sum(map(len, parts))} files in {len(parts)} shards "
+                f"via {dispatch.__name__}.")
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, len(parts))) as pool:
+        futures = {pool.submit(dispatch, i, part): (i, part) for i, part in enumerate(parts)}
+        for fut in as_completed(futures):
+            i, part = futures[fut]
+            try:
+                res = dict(fut.result())
+            except Exception as e:
+                logger.exception(f"Shard {i} failed")
+                res = {"files": len(part), "inserted": 0, "errors": len(part), "invalid": 0, "failure": str(e)}
+            res["shard"] = i
+            logger.info(f"Shard {i}: {res['inserted']}/{res['files']} inserted, "
+                        f"{res['errors']} errors, {res['invalid']} invalid.")
+            results.append(res)
+
+    results.sort(key=lambda r: r["shard"])
+    totals = {k: sum(r[k] for r in results) for k in ("files", "inserted", "errors", "invalid")}
+    logger.info(f"Fan-out complete: {totals}")
+    return {"shards": results, "totals": totals}
 
 
 def insert_jsons_to_bq_fn(request: Request):
     """
     HTTP Cloud Function entry point for loading JSONs into BigQuery.
+
+    Body / query parameter `mode` selects the behaviour:
+      (none)       load everything pending in this invocation
+      coordinator  shard the pending files and dispatch them to workers
+      worker       load those `files` listed in the JSON body that are not yet in BQ
+    Add ?profile=1 (or set PROFILE=1) to write a CPU/allocation profile.
     """
     try:
-        load_json_files_to_bq()
-        return make_response("JSON load completed.", 200)
+        body = request.get_json(silent=True) or {}
+        mode = body.get("mode") or request.args.get("mode", "")
+        name = f"load_json_files_to_bq-{mode}" if mode else "load_json_files_to_bq"
+        with profiling_hooks.profile(name, profiling_hooks.requested(request)):
+            if mode == "worker":
+                res = load_new_files(body.get("files", []))
+                res["shard"] = body.get("shard")
+                return make_response(res, 200)
+            if mode == "coordinator":
+                shards = int(body.get("shards") or request.args.get("shards", SHARD_COUNT))
+                return make_response(run_coordinator(shards), 200)
+            load_json_files_to_bq()
+            return make_response("JSON load completed.", 200)
     except Exception as e:
         logger.exception("Error loading JSONs to BQ")
         return make_response(f"Error: {e}", 500)
+
+
+# ─── EVENT-DRIVEN MICRO-BATCHING ───────────────────────────────────────────────
+# Object-finalize events are queued per instance and flushed together once
+# MICRO_BATCH_SIZE names are waiting, the oldest has waited
+# MICRO_BATCH_MAX_AGE_SEC, or no other event is in flight on the instance to
+# join the batch. Batches of more than one therefore only form when the
+# instance handles events concurrently (gen2 deployed with --concurrency > 1);
+# at concurrency 1 every event flushes at once, without waiting.
+# Each invocation returns only after the batch that carries its object has
+# been flushed, so a failed flush fails (and retries) every event in it and
+# nothing is acknowledged before it is in BigQuery.
+_batch_cond = threading.Condition()
+_open_batch = None   # {"files": [...], "opened": monotonic, "done": bool, "result": dict, "error": str}
+_in_flight  = 0      # events inside enqueue_and_wait on this instance
+
+
+def flush_batch(batch: dict):
+    try:
+        logger.info(f"Flushing micro-batch of {len(batch['files'])} files.")
+        batch["result"] = load_new_files(batch["files"])
+        if batch["result"]["errors"]:
+            batch["error"] = f"{batch['result']['errors']} insert errors"
+    except Exception as e:
+        logger.exception("Micro-batch flush failed")
+        batch["error"] = str(e)
+    with _batch_cond:
+        batch["done"] = True
+        _batch_cond.notify_all()
+
+
+def enqueue_and_wait(file_name: str) -> dict:
+    """Add `file_name` to the open micro-batch and block until that batch is flushed."""
+    global _open_batch, _in_flight
+    with _batch_cond:
+        _in_flight += 1
+        if _open_batch is None:
+            _open_batch = {"files": [], "opened": time.monotonic(), "done": False, "result": None, "error": None}
+        batch = _open_batch
+        batch["files"].append(file_name)
+        flush = False
+        while _open_batch is batch:  # until someone takes it to flush
+            remaining = batch["opened"] + MICRO_BATCH_MAX_AGE_SEC - time.monotonic()
+            if len(batch["files"]) >= min(MICRO_BATCH_SIZE, _in_flight) or remaining <= 0:
+                flush, _open_batch = True, None
+                break
+            _batch_cond.wait(remaining)
+
+    try:
+        if flush:
+            flush_batch(batch)
+        else:
+            with _batch_cond:
+                while not batch["done"]:
+                    _batch_cond.wait()
+    finally:
+        with _batch_cond:
+            _in_flight -= 1
+            _batch_cond.notify_all()  # an open batch may now be all that is in flight
+    if batch["error"]:
+        raise RuntimeError(f"Micro-batch with {file_name} failed: {batch['error']}")
+    return batch["result"]
+
+
+@functions_framework.cloud_event
+def ingest_json_on_finalize(cloud_event):
+    """
+    CloudEvent entry point for google.cloud.storage.object.v1.finalized
+    on the source bucket: loads the new object via a micro-batch.
+    """
+    data = cloud_event.data
+    name = data.get("name", "")
+    if data.get("bucket") != BUCKET_NAME or not name.startswith(PREFIX) or not name.lower().endswith(".json"):
+        logger.debug(f"Ignoring gs://{data.get('bucket')}/{name}")
+        return
+    result = enqueue_and_wait(name[len(PREFIX):])
+    logger.info(f"Event for {name} done: {result}")
+
+
+class LocalFinalizeEvent:
+    """Stand-in for a storage finalize CloudEvent in local runs."""
+
+    def __init__(self, name: str, bucket: str = BUCKET_NAME):
+        self.data = {"bucket": bucket, "name": name}
+        self._attributes = {
+            "type":    "google.cloud.storage.object.v1.finalized",
+            "source":  f"//storage.googleapis.com/projects/_/buckets/{bucket}",
+            "subject": f"objects/{name}",
+        }
+
+    def __getitem__(self, key):
+        return self._attributes[key]
+
+
+def replay_events(names: list):
+    """Fire finalize events for `names` concurrently, as a burst of uploads would."""
+    ensure_table(DATASET_ID, TABLE_ID)
+    with ThreadPoolExecutor(max_workers=max(1, len(names))) as pool:
+        futures = {pool.submit(ingest_json_on_finalize, LocalFinalizeEvent(n)): n for n in names}
+        for fut in as_completed(futures):
+            try:
+                fut.result()
+            except Exception as e:
+                logger.error(f"Event for {futures[fut]} failed: {e}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["events"]:
+        # Local harness: `events a.json b.json ...` replays finalize events
+        replay_events(sys.argv[2:])
+    else:
+        # Local harness: coordinator with in-process workers
+        with profiling_hooks.profile("load_json_files_to_bq-coordinator"):
+            print(json.dumps(run_coordinator(dispatch=dispatch_local)["totals"]))
@@ -21,6 +21,8 @@ from google.cloud import storage, bigquery
 from google.oauth2 import service_account
 from google.api_core.exceptions import NotFound
 
+import raw_schema
+
 # --- CONFIG ---
 PROJECT_ID  = "data-management-2-manoj"
 BUCKET_NAME = "cricket_analytics_src"
@@ -50,13 +52,7 @@ def ensure_table(dataset_id: str, table_id: str) -> bigquery.TableReference:
         bq_client.get_table(table_ref)
         print(f"Table `{PROJECT_ID}.{dataset_id}.{table_id}` already exists.")
     except NotFound:
-        schema = [
-            bigquery.SchemaField("file_name",              "STRING",    mode="REQUIRED"),
-            bigquery.SchemaField("content",                "JSON",      mode="REQUIRED"),
-            bigquery.SchemaField("file_upload_timestamp",  "TIMESTAMP", mode="REQUIRED"),
-        ]
-        table = bigquery.Table(table_ref, schema=schema)
-        bq_client.create_table(table)
+        bq_client.create_table(raw_schema.new_table(table_ref))
         print(f"Created table `{PROJECT_ID}.{dataset_id}.{table_id}`.")
     return table_ref
 
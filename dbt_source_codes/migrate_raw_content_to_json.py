@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+migrate_raw_content_to_json.py
+
+Converts `content` in cricket_raw.cricket_match_raw from STRING to the
+native JSON type used by raw_schema.py, in place and in batches, and
+measures what the staging models process before and after.
+
+Usage (ADC, run from anywhere):
+  1) dbt compile
+     python migrate_raw_content_to_json.py measure before
+  2) pause the JSON loaders (UPDATE cannot touch rows still in the
+     streaming buffer), then
+     python migrate_raw_content_to_json.py migrate
+  3) dbt run -s stg_cricket_match+
+     python migrate_raw_content_to_json.py measure after
+
+`migrate` adds a JSON column content_json, fills it batch by batch with
+SAFE.PARSE_JSON(content) (each batch is a FARM_FINGERPRINT(file_name)
+bucket, so a rerun resumes where it stopped), refuses to continue while
+any row fails to parse, and finally drops the STRING column and renames
+content_json to content. BigQuery only adds NULLABLE columns, so the
+migrated column is NULLABLE rather than REQUIRED. Set DRY_RUN=1 to print
+every statement, including the verify query and the final column swap,
+without running any of them.
+
+`measure` dry-runs the compiled SQL of the staging models for bytes
+processed (MEASURE_EXECUTE=1 also runs them, wrapped in COUNT(*), to
+capture slot time) and stores the result under the given label; once
+both labels exist the before/after comparison is printed.
+"""
+import os
+import sys
+import json
+import logging
+
+from google.cloud import bigquery
+from google.api_core.exceptions import BadRequest
+
+import raw_schema
+
+# ─── CONFIG ────────────────────────────────────────────────────────────────────
+DATASET_ID      = os.getenv("BQ_DATASET", "cricket_raw")
+TABLE_ID        = os.getenv("BQ_TABLE", "cricket_match_raw")
+BATCHES         = int(os.getenv("MIGRATION_BATCHES", "16"))
+DRY_RUN         = os.getenv("DRY_RUN", "") == "1"
+MEASURE_EXECUTE = os.getenv("MEASURE_EXECUTE", "") == "1"
+
+PROJECT_ROOT   = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+COMPILED_DIR   = os.getenv("DBT_COMPILED_DIR", os.path.join(
+    PROJECT_ROOT, "target", "compiled", "online_shop", "models", "staging"))
+MEASURE_PATH   = os.getenv("MEASURE_PATH", os.path.join(PROJECT_ROOT, "json_migration_bytes.json"))
+STAGING_MODELS = ["stg_cricket_match", "stg_match_info", "stg_match_innings"]
+
+TMP_COLUMN = "content_json"
+
+# ─── LOGGING SETUP ─────────────────────────────────────────────────────────────
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# ─── CLIENT (ADC) ──────────────────────────────────────────────────────────────
+bq_client = bigquery.Client()
+
+
+def run(sql: str):
+    logger.info(("[dry run] " if DRY_RUN else "") + " ".join(sql.split()))
+    if DRY_RUN:
+        return None
+    job = bq_client.query(sql)
+    job.result()
+    return job
+
+
+def migrate():
+    table_id = f"{bq_client.project}.{DATASET_ID}.{TABLE_ID}"
+    table = bq_client.get_table(table_id)
+    current = raw_schema.content_type(table)
+    if current == raw_schema.CONTENT_TYPE:
+        logger.info(f"{table_id}.content is already {current}; nothing to migrate.")
+        return
+
+    # 1) Add the JSON column (a no-op when resuming)
+    run(f"ALTER TABLE `{table_id}` ADD COLUMN IF NOT EXISTS {TMP_COLUMN} JSON")
+
+    # 2) Fill it in fingerprint buckets
+    for i in range(BATCHES):
+        try:
+            job = run(f"""
+                UPDATE `{table_id}`
+                SET {TMP_COLUMN} = SAFE.PARSE_JSON(content)
+                WHERE {TMP_COLUMN} IS NULL
+                  AND MOD(ABS(FARM_FINGERPRINT(file_name)), {BATCHES}) = {i}
+            """)
+        except BadRequest as e:
+            logger.error(f"Batch {i + 1}/{BATCHES} failed: {e}. "
+                         "If rows are still in the streaming buffer, pause the loaders and rerun.")
+            raise SystemExit(1)
+        if job is not None:
+            logger.info(f"Batch {i + 1}/{BATCHES}: {job.num_dml_affected_rows} rows converted.")
+
+    # 3) Every row must have parsed before the STRING column goes away
+    job = run(f"""
+        SELECT file_name FROM `{table_id}`
+        WHERE {TMP_COLUMN} IS NULL LIMIT 20
+    """)
+    rows = list(job.result()) if job is not None else []
+    if rows:
+        logger.error(f"{len(rows)}+ rows did not parse as JSON, e.g. "
+                     f"{[r.file_name for r in rows]}; fix or delete them and rerun.")
+        raise SystemExit(1)
+
+    # 4) Swap the columns
+    run(f"ALTER TABLE `{table_id}` DROP COLUMN content")
+    run(f"ALTER TABLE `{table_id}` RENAME COLUMN {TMP_COLUMN} TO content")
+    if not DRY_RUN:
+        logger.info(f"{table_id}.content is now JSON.")
+
+
+def measure_model(sql: str) -> dict:
+    dry = bq_client.query(sql, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False))
+    out = {"dry_run_bytes": dry.total_bytes_processed}
+    if MEASURE_EXECUTE:
+        job = bq_client.query(f"SELECT COUNT(*) FROM ({sql})",
+                              job_config=bigquery.QueryJobConfig(use_query_cache=False))
+        job.result()
+        out.update({
+            "bytes_processed": job.total_bytes_processed,
+            "bytes_billed":    job.total_bytes_billed,
+            "slot_ms":         job.slot_millis,
+        })
+    return out
+
+
+def measure(label: str):
+    results = {}
+    if os.path.exists(MEASURE_PATH):
+        with open(MEASURE_PATH, encoding="utf-8") as f:
+            results = json.load(f)
+
+    results[label] = {}
+    for model in STAGING_MODELS:
+        path = os.path.join(COMPILED_DIR, f"{model}.sql")
+        if not os.path.exists(path):
+            logger.warning(f"No compiled SQL for {model} at {path}; run `dbt compile` first.")
+            continue
+        with open(path, encoding="utf-8") as f:
+            results[label][model] = measure_model(f.read())
+        logger.info(f"{label} {model}: {results[label][model]}")
+
+    with open(MEASURE_PATH, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    if "before" in results and "after" in results:
+        print(format_comparison(results["before"], results["after"]))
+
+
+def format_comparison(before: dict, after: dict) -> str:
+    lines = [f"{'model':<20} {'metric':<14} {'before':>14} {'after':>14} {'change':>8}"]
+    for model in STAGING_MODELS:
+        b, a = before.get(model, {}), after.get(model, {})
+        for metric in ("dry_run_bytes", "bytes_processed", "bytes_billed", "slot_ms"):
+            if metric not in b or metric not in a:
+                continue
+            change = f"{100 * (a[metric] - b[metric]) / b[metric]:+.1f}%" if b[metric] else "n/a"
+            lines.append(f"{model:<20} {metric:<14} {b[metric]:>14,} {a[metric]:>14,} {change:>8}")
+    return "\n".join(lines)
+
+
+def main():
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
+        migrate()
+    elif len(sys.argv) >= 3 and sys.argv[1] == "measure":
+        measure(sys.argv[2])
+    else:
+        raise SystemExit("usage: migrate_raw_content_to_json.py migrate | measure <label>")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+profiling_hooks.py
+
+Opt-in profiling for the ingestion and enrichment entry points.
+
+1) Enabled per run by PROFILE=1 or, for HTTP functions, ?profile=1;
+   when off, `profile()` only checks the flag and yields.
+2) A background thread samples, at a fixed interval, the stacks of the
+   thread that entered profile() and of threads started while it runs,
+   skipping threads parked in a lock, condition or queue wait. Hottest
+   functions (self and inclusive) are shares of those stack samples.
+   Meanwhile tracemalloc records allocations (peak traced memory).
+   Whenever traced memory has grown by PROFILE_SNAPSHOT_STEP_MB since the
+   last snapshot, the sampler takes a new one, so the top allocation
+   sites are those live near the peak rather than after the block has
+   freed them.
+3) Writes a text report and a JSON summary to PROFILE_OUTPUT, a local
+   directory or a gs://bucket/prefix.
+4) With PROFILE_BASELINE pointing at an earlier JSON summary, the report
+   also shows wall, CPU and peak-memory deltas against it.
+
+One profile runs at a time per process: a block entered while another
+is active (concurrent invocations on one instance) runs unprofiled.
+Profiling errors are logged and never fail the profiled block.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# ─── CONFIG ────────────────────────────────────────────────────────────────────
+PROFILE_OUTPUT   = os.getenv("PROFILE_OUTPUT", "/tmp/profiles")   # dir or gs://bucket/prefix
+PROFILE_BASELINE = os.getenv("PROFILE_BASELINE", "")              # earlier JSON summary
+SAMPLE_INTERVAL  = float(os.getenv("PROFILE_SAMPLE_SEC", "0.005"))
+TRACE_FRAMES     = int(os.getenv("PROFILE_TRACE_FRAMES", "1"))    # tracemalloc stack depth
+TOP_N            = int(os.getenv("PROFILE_TOP_N", "15"))
+SNAPSHOT_STEP    = float(os.getenv("PROFILE_SNAPSHOT_STEP_MB", "4")) * 1024 * 1024
+
+TRUTHY = ("1", "true", "yes")
+
+logger = logging.getLogger(__name__)
+
+_active = threading.Lock()   # held while a profile is being taken
+
+# innermost Python frames of a thread that is waiting, not running
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),   # concurrent.futures worker waiting for work
+}
+
+
+def requested(request=None) -> bool:
+    """True when profiling was asked for via env var or the request's ?profile=."""
+    if os.getenv("PROFILE", "").lower() in TRUTHY:
+        return True
+    args = getattr(request, "args", None)
+    return bool(args) and args.get("profile", "").lower() in TRUTHY
+
+
+def _frame_key(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno} {code.co_name}"
+
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ])
+
+
+def _idle(frame) -> bool:
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES
+
+
+def _sample(stop: threading.Event, others: set, self_counts: Counter, incl_counts: Counter,
+            taken: list, high: dict):
+    """Sample threads not in `others` (those that existed before the profile began)."""
+    own_ident = threading.get_ident()
+    while not stop.wait(SAMPLE_INTERVAL):
+        current, _ = tracemalloc.get_traced_memory()
+        if current >= high["bytes"] + SNAPSHOT_STEP:
+            high.update(bytes=current, snapshot=_snapshot())
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident or ident in others or _idle(frame):
+                continue
+            self_counts[_frame_key(frame)] += 1
+            seen = set()
+            while frame is not None:
+                seen.add(_frame_key(frame))
+                frame = frame.f_back
+            incl_counts.update(seen)
+            taken[0] += 1
+
+
+@contextmanager
+def profile(name: str, enabled: bool = None):
+    """Profile the enclosed block when `enabled` (default: `requested()`)."""
+    if enabled is None:
+        enabled = requested()
+    if not enabled:
+        yield
+        return
+    if not _active.acquire(blocking=False):
+        logger.warning(f"Another profile is active in this process; {name} runs unprofiled.")
+        yield
+        return
+
+    try:
+        started_at = datetime.now(timezone.utc)
+        self_counts, incl_counts, taken = Counter(), Counter(), [0]
+        high = {"bytes": 0, "snapshot": None}   # allocation snapshot at the highest traced memory
+        others = {t.ident for t in threading.enumerate()} - {threading.get_ident()}
+        stop = threading.Event()
+        sampler = threading.Thread(target=_sample, args=(stop, others, self_counts, incl_counts, taken, high),
+                                   name="profiling-sampler", daemon=True)
+        # a tracer started by someone else keeps its peak; ours starts fresh
+        owns_tracemalloc = not tracemalloc.is_tracing()
+        if owns_tracemalloc:
+            tracemalloc.start(TRACE_FRAMES)
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        sampler.start()
+    except Exception:
+        logger.exception(f"Could not start profile for {name}")
+        _active.release()
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        try:
+            stop.set()
+            sampler.join()
+            wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+            current, peak = tracemalloc.get_traced_memory()
+            if high["snapshot"] is None or current >= high["bytes"]:
+                high.update(bytes=current, snapshot=_snapshot())
+            summary = summarise(name, started_at, wall, cpu, peak, taken[0], self_counts, incl_counts,
+                                high["snapshot"], high["bytes"])
+            write_report(summary)
+        except Exception:
+            logger.exception(f"Could not write profile for {name}")
+        finally:
+            if owns_tracemalloc and tracemalloc.is_tracing():
+                tracemalloc.stop()
+            _active.release()
+
+
+def summarise(name, started_at, wall, cpu, peak, samples, self_counts, incl_counts,
+              snapshot, snapshot_bytes) -> dict:
+    def hot(counts):
+        return [{"func": f, "samples": n, "pct": round(100 * n / samples, 1) if samples else 0.0}
+                for f, n in counts.most_common(TOP_N)]
+
+    allocs = [
+        {"site": str(stat.traceback[0]), "bytes": stat.size, "count": stat.count}
+        for stat in snapshot.statistics("lineno")[:TOP_N]
+    ]
+    return {
+        "name":          name,
+        "started_at":    started_at.isoformat().replace("+00:00", "Z"),
+        "wall_sec":      round(wall, 3),
+        "cpu_sec":       round(cpu, 3),
+        "peak_bytes":    peak,
+        "samples":       samples,
+        "interval_sec":  SAMPLE_INTERVAL,
+        "hot_self":      hot(self_counts),
+        "hot_inclusive": hot(incl_counts),
+        "alloc_top":     allocs,
+        "alloc_at_bytes": snapshot_bytes,
+    }
+
+
+def _mib(n):
+    return f"{n / 1024 / 1024:.1f} MiB"
+
+
+def compare(summary: dict, baseline: dict) -> list:
+    """Per-metric deltas of `summary` against an earlier `baseline` summary."""
+    lines = []
+    for key, label, fmt in (("wall_sec", "wall", "{:.2f}s"), ("cpu_sec", "cpu", "{:.2f}s"),
+                            ("peak_bytes", "peak", None)):
+        old, new = baseline.get(key) or 0, summary[key]
+        pct = f"{100 * (new - old) / old:+.1f}%" if old else "n/a"
+        show = (lambda v: fmt.format(v)) if fmt else _mib
+        lines.append(f"  {label:<5} {show(old):>10} -> {show(new):>10}  ({pct})")
+    return lines
+
+
+def format_report(summary: dict, baseline: dict = None) -> str:
+    lines = [
+        f"Profile: {summary['name']}  {summary['started_at']}",
+        f"wall {summary['wall_sec']:.2f}s  cpu {summary['cpu_sec']:.2f}s  "
+        f"samples {summary['samples']} @ {summary['interval_sec'] * 1000:.0f}ms  "
+        f"peak traced memory {_mib(summary['peak_bytes'])}",
+        "",
+        "Hottest functions (self):",
+        *[f"  {h['pct']:>5.1f}%  {h['func']}" for h in summary["hot_self"]],
+        "",
+        "Hottest functions (inclusive):",
+        *[f"  {h['pct']:>5.1f}%  {h['func']}" for h in summary["hot_inclusive"]],
+        "",
+        f"Top allocation sites (snapshot at {_mib(summary['alloc_at_bytes'])} traced):",
+        *[f"  {_mib(a['bytes']):>10}  {a['count']:>8} blocks  {a['site']}" for a in summary["alloc_top"]],
+    ]
+    if baseline:
+        lines += ["", f"Against baseline from {baseline.get('started_at', '?')}:", *compare(summary, baseline)]
+    return "\n".join(lines) + "\n"
+
+
+def write_report(summary: dict):
+    baseline = None
+    if PROFILE_BASELINE and os.path.exists(PROFILE_BASELINE):
+        with open(PROFILE_BASELINE, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    stem = f"{summary['name']}-{summary['started_at'].replace(':', '').replace('.', '')}"
+    text = format_report(summary, baseline)
+    payload = json.dumps(summary, indent=2)
+
+    if PROFILE_OUTPUT.startswith("gs://"):
+        from google.cloud import storage
+
+        bucket_name, _, prefix = PROFILE_OUTPUT[len("gs://"):].partition("/")
+        bucket = storage.Client().bucket(bucket_name)
+        prefix = f"{prefix.rstrip('/')}/" if prefix else ""
+        bucket.blob(f"{prefix}{stem}.txt").upload_from_string(text, content_type="text/plain")
+        bucket.blob(f"{prefix}{stem}.json").upload_from_string(payload, content_type="application/json")
+        where = f"gs://{bucket_name}/{prefix}{stem}"
+    else:
+        os.makedirs(PROFILE_OUTPUT, exist_ok=True)
+        where = os.path.join(PROFILE_OUTPUT, stem)
+        with open(f"{where}.txt", "w", encoding="utf-8") as f:
+            f.write(text)
+        with open(f"{where}.json", "w", encoding="utf-8") as f:
+            f.write(payload)
+    logger.info(f"Profile for {summary['name']} written to {where}.txt/.json")
@@ -4,7 +4,8 @@
 #
 # Incrementally load all new JSON files from GCS into
 #   data-management-2-manoj.cricket_raw.cricket_match_raw
-# with columns (file_name STRING, content JSON, file_upload_timestamp TIMESTAMP).
+# with columns (file_name STRING, content JSON, file_upload_timestamp TIMESTAMP),
+# the same schema as raw_schema.py uses for the Python loaders.
 #
 
 from pyspark.sql import SparkSession
@@ -36,10 +37,10 @@ def main():
              .select("file_name")
     )
 
-    # 2) Read each JSON as raw text, capture its full path
+    # 2) Read each JSON file as one raw text value, capture its full path
     raw = (
         spark.read
-             .text(gcs_pattern)
+             .text(gcs_pattern, wholetext=True)
              .withColumn("full_path", input_file_name())
     )
 
@@ -54,16 +55,15 @@ def main():
     )
 
     # 4) Build the final DataFrame with JSON metadata on `content`
+    #    (set in the final select so no later projection drops the metadata)
     to_write = (
         new_files
-        # annotate the column so the connector knows it's JSON :contentReference[oaicite:0]{index=0}
-        .withColumn(
-            "content",
-            col("value")
-              .alias("content", metadata={"sqlType": "JSON"})
+        .select(
+            "file_name",
+            # annotate the column so the connector writes it as BigQuery JSON
+            col("value").alias("content", metadata={"sqlType": "JSON"}),
+            current_timestamp().alias("file_upload_timestamp"),
         )
-        .withColumn("file_upload_timestamp", current_timestamp())
-        .select("file_name", "content", "file_upload_timestamp")
     )
 
     # 5) Append into BigQuery via the connector (indirect + Avro) :contentReference[oaicite:1]{index=1}
@@ -76,6 +76,7 @@ def main():
                 .option("writeDisposition",   "WRITE_APPEND")
                 .option("writeMethod",        "indirect")
                 .option("intermediateFormat", "avro")
+                .option("clusteredFields",    "file_name")   # as raw_schema.CLUSTERING_FIELDS
                 .save()
     )
 
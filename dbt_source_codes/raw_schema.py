@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+raw_schema.py
+
+Single definition of the raw match table
+  cricket_raw.cricket_match_raw
+shared by every loader. `content` is BigQuery's native JSON type, so the
+staging models' JSON_EXTRACT_ARRAY / JSON_VALUE calls work on parsed
+values instead of re-parsing text on every build.
+
+The table is clustered on file_name, so the loaders' "is this file
+already loaded" lookups read only the matching blocks.
+
+The Spark loader (pySpark_to_bq.py) runs standalone on Dataproc and
+mirrors this with `metadata={"sqlType": "JSON"}` on `content` and the
+connector's clusteredFields option.
+"""
+
+from google.cloud import bigquery
+
+RAW_COLUMNS = [
+    # name                    type         mode
+    ("file_name",             "STRING",    "REQUIRED"),
+    ("content",               "JSON",      "REQUIRED"),
+    ("file_upload_timestamp", "TIMESTAMP", "REQUIRED"),
+]
+CONTENT_TYPE = "JSON"
+CLUSTERING_FIELDS = ["file_name"]
+
+
+def bigquery_schema() -> list:
+    return [bigquery.SchemaField(name, ftype, mode=mode) for name, ftype, mode in RAW_COLUMNS]
+
+
+def new_table(table_ref) -> bigquery.Table:
+    """Table definition for create_table(): schema plus clustering."""
+    table = bigquery.Table(table_ref, schema=bigquery_schema())
+    table.clustering_fields = CLUSTERING_FIELDS
+    return table
+
+
+def content_type(table: bigquery.Table) -> str:
+    """Field type of `content` in an existing table (e.g. "STRING" or "JSON")."""
+    for field in table.schema:
+        if field.name == "content":
+            return field.field_type
+    return ""
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+run_pipeline.py
+
+Single entry point for the daily refresh, run as a DAG of stages:
+
+    upload_json ──▶ load_json ─────┐
+                                   ├──▶ dbt_run
+    enrich_weather ──▶ load_weather┘
+
+1) Stages whose upstreams are done start immediately, so the JSON and
+   weather branches run concurrently.
+2) Every stage reports how much it changed. A stage whose upstreams all
+   changed nothing still runs if it has work of its own pending (files
+   not yet loaded, raw tables newer than this pipeline's last successful
+   dbt run) or if an earlier pipeline run started or blocked it without
+   finishing it. Both are kept in PIPELINE_STATE. Otherwise it is skipped.
+3) A failed stage blocks its downstream stages; the others carry on.
+4) Prints wall time per stage and the critical path at the end.
+
+Set SKIP_STAGES (comma separated) to leave stages out, e.g. upload_json
+when there is no local JSON dir; a left-out stage does not suppress its
+downstream. FORCE_ALL=1 runs every stage regardless of change signals.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import importlib
+import subprocess
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# ─── CONFIG ────────────────────────────────────────────────────────────────────
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SKIP_STAGES  = {s.strip() for s in os.getenv("SKIP_STAGES", "").split(",") if s.strip()}
+FORCE_ALL    = os.getenv("FORCE_ALL", "") == "1"
+DBT_COMMAND  = os.getenv("DBT_COMMAND", "dbt run").split()
+STATE_PATH   = os.getenv("PIPELINE_STATE", os.path.join(PROJECT_ROOT, "pipeline_state.json"))
+RAW_DATASET  = os.getenv("BQ_DATASET", "cricket_raw")  # dbt sources for the freshness check
+
+# ─── LOGGING SETUP ─────────────────────────────────────────────────────────────
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(threadName)s %(message)s")
+logger = logging.getLogger(__name__)
+
+
+# ─── STAGES ────────────────────────────────────────────────────────────────────
+# Each stage returns how many things it changed; 0 means "nothing new".
+# Modules are imported lazily because they build their clients at import.
+
+def stage_upload_json() -> int:
+    return importlib.import_module("upload-to_bucket").main()
+
+
+def stage_load_json() -> int:
+    return importlib.import_module("insert_in_chunks_bq").load_json_files_to_bq()
+
+
+def stage_enrich_weather() -> int:
+    return importlib.import_module("fetch_schedule_weather").main()
+
+
+def stage_load_weather() -> int:
+    importlib.import_module("spark_submit_fn").submit_spark_job()
+    return 1
+
+
+def stage_dbt_run() -> int:
+    logger.info(f"Running `{' '.join(DBT_COMMAND)}` in {PROJECT_ROOT}")
+    subprocess.run(DBT_COMMAND, cwd=PROJECT_ROOT, check=True)
+    return 1
+
+
+# ─── PENDING CHECKS ────────────────────────────────────────────────────────────
+# How much work a stage has waiting regardless of what its upstreams did.
+# Each gets the start time of the stage's last successful pipeline run
+# (None if it never succeeded here).
+
+def pending_load_json(last_ok) -> int:
+    return len(importlib.import_module("insert_in_chunks_bq").list_pending_files())
+
+
+def pending_dbt_run(last_ok) -> int:
+    """
+    Raw tables modified since the last successful DBT_COMMAND from this
+    pipeline. dbt invocations outside it (compile, test, partial runs)
+    do not count as a rebuild.
+    """
+    if last_ok is None:
+        return 1
+    from google.cloud import bigquery
+
+    client = bigquery.Client()
+    newer = [t.table_id for t in client.list_tables(RAW_DATASET)
+             if client.get_table(t.reference).modified > last_ok]
+    if newer:
+        logger.info(f"Raw tables newer than the last dbt run ({last_ok}): {', '.join(newer)}")
+    return len(newer)
+
+
+STAGES = {
+    # name:           (upstream stages,                runner,                pending check)
+    "upload_json":    ([],                             stage_upload_json,     None),
+    "load_json":      (["upload_json"],                stage_load_json,       pending_load_json),
+    "enrich_weather": ([],                             stage_enrich_weather,  None),
+    "load_weather":   (["enrich_weather"],             stage_load_weather,    None),
+    "dbt_run":        (["load_json", "load_weather"],  stage_dbt_run,         pending_dbt_run),
+}
+
+
+# ─── STATE ─────────────────────────────────────────────────────────────────────
+def load_state(path: str = STATE_PATH) -> dict:
+    """
+    owed:    stages an earlier pipeline run started or blocked but did not finish
+    last_ok: per stage, the start time of its last successful run
+    """
+    state = {"owed": set(), "last_ok": {}}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            saved = json.load(f)
+        state["owed"] = set(saved.get("owed", []))
+        state["last_ok"] = {k: datetime.fromisoformat(v) for k, v in saved.get("last_ok", {}).items()}
+    return state
+
+
+def save_state(state: dict, path: str = STATE_PATH):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({
+            "owed":    sorted(state["owed"]),
+            "last_ok": {k: v.isoformat() for k, v in state["last_ok"].items()},
+        }, f, indent=2)
+
+
+# ─── SCHEDULER ─────────────────────────────────────────────────────────────────
+def run_stage(name: str, runner) -> dict:
+    started_at = datetime.now(timezone.utc)
+    start = time.monotonic()
+    try:
+        changed = runner() or 0
+        status, detail = "ok", f"{changed} changed"
+    except BaseException as e:  # stages may raise SystemExit
+        logger.exception(f"Stage {name} failed")
+        changed, status, detail = 0, "failed", str(e)
+    return {"status": status, "changed": changed, "seconds": time.monotonic() - start, "detail": detail,
+            "started_at": started_at}
+
+
+def has_pending(name: str, check, last_ok=None) -> bool:
+    if check is None:
+        return False
+    try:
+        return check(last_ok) > 0
+    except Exception as e:
+        logger.warning(f"Pending check for {name} failed ({e}); running it anyway.")
+        return True
+
+
+def decide(name: str, results: dict, stages: dict = STAGES, state: dict = None):
+    """Return a result for `name` without running it, or None if it should run."""
+    upstream, _, check = stages[name]
+    if name in SKIP_STAGES:
+        # unknown outcome: treat as changed so downstream still runs
+        return {"status": "disabled", "changed": 1, "seconds": 0.0, "detail": "in SKIP_STAGES"}
+    blocked = [u for u in upstream if results[u]["status"] in ("failed", "blocked")]
+    if blocked:
+        return {"status": "blocked", "changed": 0, "seconds": 0.0, "detail": f"upstream failed: {', '.join(blocked)}"}
+    if not upstream or FORCE_ALL or any(results[u]["changed"] for u in upstream):
+        return None
+    state = state or {"owed": set(), "last_ok": {}}
+    if name in state["owed"]:
+        logger.info(f"Stage {name}: not finished by an earlier run; running it.")
+        return None
+    if has_pending(name, check, state["last_ok"].get(name)):
+        return None
+    return {"status": "skipped", "changed": 0, "seconds": 0.0, "detail": "no upstream changes, nothing pending"}
+
+
+def run_pipeline(stages: dict = STAGES, state_path: str = STATE_PATH) -> dict:
+    results, running = {}, {}
+    state = load_state(state_path)
+    with ThreadPoolExecutor(max_workers=len(stages), thread_name_prefix="stage") as pool:
+        while len(results) < len(stages):
+            for name, (upstream, runner, _) in stages.items():
+                if name in results or name in running:
+                    continue
+                if not all(u in results for u in upstream):
+                    continue
+                outcome = decide(name, results, stages, state)
+                if outcome is not None:
+                    logger.info(f"Stage {name}: {outcome['status']} ({outcome['detail']})")
+                    results[name] = outcome
+                    if outcome["status"] == "blocked":
+                        state["owed"].add(name)
+                        save_state(state, state_path)
+                    break  # re-scan: this may unblock more stages
+                logger.info(f"Stage {name}: starting")
+                state["owed"].add(name)  # cleared once it finishes ok
+                save_state(state, state_path)
+                running[name] = pool.submit(run_stage, name, runner)
+            else:
+                if not running:
+                    break
+                done, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+                for name in [n for n, f in running.items() if f in done]:
+                    results[name] = running.pop(name).result()
+                    logger.info(f"Stage {name}: {results[name]['status']} "
+                                f"in {results[name]['seconds']:.1f}s ({results[name]['detail']})")
+                    if results[name]["status"] == "ok":
+                        state["owed"].discard(name)
+                        state["last_ok"][name] = results[name]["started_at"]
+                        save_state(state, state_path)
+    return results
+
+
+def critical_path(results: dict, stages: dict = STAGES):
+    """Longest chain of stage wall times through the DAG."""
+    finish, best = {}, {}
+    for name, (upstream, _, _) in stages.items():  # STAGES is declared in topological order
+        prev = max(upstream, key=lambda u: finish[u], default=None)
+        best[name] = prev
+        finish[name] = (finish[prev] if prev else 0.0) + results[name]["seconds"]
+    end = max(finish, key=finish.get)
+    path = []
+    while end:
+        path.append(end)
+        end = best[end]
+    return path[::-1], finish[path[0]]
+
+
+def main():
+    start = time.monotonic()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    results = run_pipeline()
+    wall = time.monotonic() - start
+
+    print("\nStage            status     seconds  detail")
+    for name, r in results.items():
+        print(f"{name:<16} {r['status']:<9} {r['seconds']:>8.1f}  {r['detail']}")
+    path, path_time = critical_path(results)
+    summed = sum(r["seconds"] for r in results.values())
+    print(f"\nWall time {wall:.1f}s (stages summed {summed:.1f}s)")
+    print(f"Critical path {path_time:.1f}s: {' -> '.join(path)}")
+
+    if any(r["status"] in ("failed", "blocked") for r in results.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
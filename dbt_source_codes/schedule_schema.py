@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+schedule_schema.py
+
+Typed in-memory layout for the IPL schedule and weather-enriched frames.
+
+1) Reads only the columns the enricher uses, with explicit dtypes:
+   categoricals for repeated strings, float32 weather values and
+   real datetime columns instead of DD/MM/YYYY / HH:MM text.
+2) Concatenates small frames (checkpoint + new records) with aligned
+   dtypes, so the concat never falls back to object columns.
+3) Serialises back to the on-disk CSV format expected downstream, and
+   appends new rows to existing CSV bytes without parsing the old rows
+   into a frame.
+4) Reports per-frame memory usage.
+"""
+
+import io
+
+import pandas as pd
+
+# ─── COLUMNS ───────────────────────────────────────────────────────────────────
+SCHEDULE_COLS = [
+    "season","match_id","city","match_num","venue",
+    "match_date","match_time","team1","team2","venue_id",
+    "latitude","longitude"
+]
+WEATHER_COLS = [
+    "datetime","temp_C","humidity_%","pressure_hPa",
+    "cloudcover_%","rain_mm","wind_m_s"
+]
+ENRICHED_COLS = SCHEDULE_COLS + WEATHER_COLS
+
+CATEGORY_COLS = ["season", "city", "match_num", "venue", "match_time", "team1", "team2"]
+WEATHER_VALUE_COLS = WEATHER_COLS[1:]
+
+# dtypes applied while parsing; match_date / datetime are parsed afterwards
+DTYPES = {
+    **{c: "category" for c in CATEGORY_COLS},
+    "match_id":  "Int64",
+    "venue_id":  "Int16",
+    "latitude":  "float64",   # kept at full precision for the weather API
+    "longitude": "float64",
+    **{c: "float32" for c in WEATHER_VALUE_COLS},
+}
+
+MATCH_DATE_FMT = "%d/%m/%Y"
+MATCH_TIME_FMT = "%H:%M"
+DATETIME_FMT   = "%Y-%m-%dT%H:%M"
+
+
+def read_frame(data: bytes, columns) -> pd.DataFrame:
+    """Parse CSV bytes, keeping only `columns` and applying the schema."""
+    wanted = set(columns)
+    df = pd.read_csv(
+        io.BytesIO(data),
+        usecols=lambda c: c in wanted,
+        dtype={c: t for c, t in DTYPES.items() if c in wanted},
+    )
+    return coerce(df)
+
+
+def empty_frame(columns=ENRICHED_COLS) -> pd.DataFrame:
+    """An empty frame that already carries the schema dtypes."""
+    return coerce(pd.DataFrame(columns=columns))
+
+
+def coerce(df: pd.DataFrame) -> pd.DataFrame:
+    """Cast every known column of `df` to its schema dtype (in place)."""
+    for col, dtype in DTYPES.items():
+        if col in df.columns and df[col].dtype != dtype:
+            df[col] = df[col].astype(dtype)
+    if "match_date" in df.columns and not pd.api.types.is_datetime64_any_dtype(df["match_date"]):
+        df["match_date"] = pd.to_datetime(df["match_date"], format=MATCH_DATE_FMT)
+    if "datetime" in df.columns and not pd.api.types.is_datetime64_any_dtype(df["datetime"]):
+        df["datetime"] = pd.to_datetime(df["datetime"], format=DATETIME_FMT)
+    return df
+
+
+def match_datetimes(df: pd.DataFrame) -> pd.Series:
+    """Kick-off datetime per row, vectorised over match_date + match_time."""
+    times = pd.to_timedelta(df["match_time"].astype(str) + ":00")
+    return df["match_date"] + times
+
+
+def append(df_old: pd.DataFrame, df_new: pd.DataFrame, columns=ENRICHED_COLS) -> pd.DataFrame:
+    """
+    Append `df_new` below `df_old` in the fixed column order.
+
+    Categories are unioned first so the categorical columns survive the
+    concat; the old frame is returned untouched when there is nothing new.
+    pd.concat always allocates the result, so both inputs are copied once:
+    use append_csv_bytes() to add rows to a large existing file.
+    """
+    if df_new.empty:
+        return df_old[columns] if list(df_old.columns) != list(columns) else df_old
+    df_new = coerce(df_new.reindex(columns=columns))
+    df_old = df_old.reindex(columns=columns)
+    for col in CATEGORY_COLS:
+        if col not in columns:
+            continue
+        cats = df_old[col].cat.categories.union(df_new[col].cat.categories)
+        df_old[col] = df_old[col].cat.set_categories(cats)
+        df_new[col] = df_new[col].cat.set_categories(cats)
+    return pd.concat([df_old, df_new], ignore_index=True)
+
+
+def to_csv_bytes(df: pd.DataFrame, header: bool = True) -> bytes:
+    """Render `df` in the original CSV text layout."""
+    out = df.copy(deep=False)
+    if "match_date" in out.columns:
+        out["match_date"] = out["match_date"].dt.strftime(MATCH_DATE_FMT)
+    if "datetime" in out.columns:
+        out["datetime"] = out["datetime"].dt.strftime(DATETIME_FMT)
+    return out.to_csv(index=False, header=header).encode("utf-8")
+
+
+def append_csv_bytes(data: bytes, df_new: pd.DataFrame, columns=ENRICHED_COLS) -> bytes:
+    """
+    Append `df_new` to the CSV `data`, leaving the existing rows as bytes.
+
+    Only when the existing header is not `columns` (e.g. an older column
+    order) is the file parsed and rewritten in full.
+    """
+    if not data:
+        return to_csv_bytes(coerce(df_new.reindex(columns=columns)))
+    header = data.split(b"\n", 1)[0].rstrip(b"\r").decode("utf-8")
+    if header.split(",") != list(columns):
+        return to_csv_bytes(append(read_frame(data, columns), df_new, columns))
+    if not data.endswith(b"\n"):
+        data += b"\n"
+    return data + to_csv_bytes(coerce(df_new.reindex(columns=columns)), header=False)
+
+
+def memory_report(frames: dict) -> str:
+    """One line per frame with its deep memory usage and the heaviest column."""
+    lines = []
+    for name, df in frames.items():
+        usage = df.memory_usage(index=True, deep=True)
+        total = usage.sum()
+        cols = usage.drop("Index")
+        top = f", largest {cols.idxmax()}={cols.max() / 1024:.1f} KiB" if len(cols) else ""
+        lines.append(f"{name}: {len(df)} rows, {total / 1024:.1f} KiB{top}")
+    return "\n".join(lines)
@@ -18,6 +18,25 @@ REGION       = "europe-west3"
 CLUSTER_NAME = "my-cluster"
 PYSPARK_URI  = "gs://cricket_analytics_src/code/load_weather_to_bq.py"
 
+def submit_spark_job() -> str:
+    """Submits the PySpark job to Dataproc and returns its job ID."""
+    logger.info(f"Using project={PROJECT_ID}, region={REGION}, cluster={CLUSTER_NAME}")
+    job_client = dataproc_v1.JobControllerClient(
+        client_options={"api_endpoint": f"{REGION}-dataproc.googleapis.com:443"}
+    )
+    job = {
+        "placement": {"cluster_name": CLUSTER_NAME},
+        "pyspark_job": {"main_python_file_uri": PYSPARK_URI},
+    }
+    operation = job_client.submit_job_as_operation(
+        request={"project_id": PROJECT_ID, "region": REGION, "job": job}
+    )
+    result = operation.result()  # waits until the submission is accepted
+    job_id = result.reference.job_id
+    logger.info(f"Submitted job ID: {job_id}")
+    return job_id
+
+
 @functions_framework.http
 def trigger_spark_job(request: Request):
     """
@@ -25,20 +44,7 @@ def trigger_spark_job(request: Request):
     Submits a PySpark job to Dataproc.
     """
     try:
-        logger.info(f"Using project={PROJECT_ID}, region={REGION}, cluster={CLUSTER_NAME}")
-        job_client = dataproc_v1.JobControllerClient(
-            client_options={"api_endpoint": f"{REGION}-dataproc.googleapis.com:443"}
-        )
-        job = {
-            "placement": {"cluster_name": CLUSTER_NAME},
-            "pyspark_job": {"main_python_file_uri": PYSPARK_URI},
-        }
-        operation = job_client.submit_job_as_operation(
-            request={"project_id": PROJECT_ID, "region": REGION, "job": job}
-        )
-        result = operation.result()  # waits until the submission is accepted
-        job_id = result.reference.job_id
-        logger.info(f"Submitted job ID: {job_id}")
+        job_id = submit_spark_job()
         return make_response(f"Spark job submitted: {job_id}", 200)
 
     except Exception as e:
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+sync_function_sources.py
+
+The Cloud Function source dirs need the shared modules next to their
+main.py. The modules live once, here in dbt_source_codes/; this copies
+them into each function dir. Run it before deploying, e.g.
+
+  python sync_function_sources.py
+  gcloud functions deploy fetch_schedule_weather --source dbt_source_codes/temp ...
+
+The copies are gitignored. `--check` only compares and exits non-zero
+when a copy is missing or differs, for use in CI or a pre-deploy hook.
+"""
+
+import os
+import sys
+import shutil
+import filecmp
+
+# ─── CONFIG ────────────────────────────────────────────────────────────────────
+HERE = os.path.dirname(os.path.abspath(__file__))
+FUNCTION_MODULES = {
+    # function source dir: shared modules it imports
+    "temp": ["schedule_schema.py", "profiling_hooks.py", "gcs_lease.py"],
+}
+
+
+def stale_copies() -> list:
+    """(source, copy) pairs whose copy is missing or differs from the source."""
+    stale = []
+    for func_dir, modules in FUNCTION_MODULES.items():
+        for module in modules:
+            src, dst = os.path.join(HERE, module), os.path.join(HERE, func_dir, module)
+            if not os.path.exists(dst) or not filecmp.cmp(src, dst, shallow=False):
+                stale.append((src, dst))
+    return stale
+
+
+def main():
+    stale = stale_copies()
+    if "--check" in sys.argv[1:]:
+        for _, dst in stale:
+            print(f"❌ {os.path.relpath(dst, HERE)} is missing or out of date")
+        if stale:
+            raise SystemExit("Run sync_function_sources.py before deploying.")
+        print("✅ Function sources are in sync.")
+        return
+    for src, dst in stale:
+        shutil.copyfile(src, dst)
+        print(f"✔️ Copied {os.path.basename(src)} -> {os.path.relpath(dst, HERE)}")
+    print(f"✅ {len(stale)} copies updated.")
+
+
+if __name__ == "__main__":
+    main()
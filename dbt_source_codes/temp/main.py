@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 import os
-import io
+import json
 import time
+import uuid
 import datetime
 import requests
 import pandas as pd
@@ -10,11 +11,19 @@ import logging
 from google.cloud import storage
 from flask import Request, make_response
 
+# shared modules, copied in from dbt_source_codes/ by sync_function_sources.py
+import gcs_lease
+import schedule_schema
+import profiling_hooks
+
 # ─── CONFIG ────────────────────────────────────────────────────────────────────
 PROJECT_ID    = os.environ.get("GCP_PROJECT") or os.environ.get("GOOGLE_CLOUD_PROJECT")
 BUCKET_NAME   = "cricket_analytics_src"
 SCHEDULE_PATH = "schedule/ipl_full_schedule.csv"
 OUTPUT_PATH   = "schedule/ipl_full_schedule_with_weather.csv"
+CHECKPOINT_PATH = "schedule/ipl_full_schedule_with_weather.checkpoint.csv"
+LEASE_PATH    = "schedule/ipl_full_schedule_with_weather.lease.json"
+FAILURES_PATH = "schedule/ipl_full_schedule_with_weather.failures.json"
 
 HOURLY_VARS = [
     "temperature_2m",
@@ -28,6 +37,21 @@ TIMEZONE    = "Asia/Kolkata"
 PAUSE_SEC   = 1.0
 MAX_RETRIES = 3  # number of fetch retries
 
+# per-run budget: stop fetching before the function deadline / API quota
+RUN_BUDGET_SEC   = float(os.getenv("RUN_BUDGET_SEC", "480"))   # function timeout minus headroom
+FLUSH_MARGIN_SEC = float(os.getenv("FLUSH_MARGIN_SEC", "30"))  # reserved for the final upload
+MAX_API_CALLS    = int(os.getenv("MAX_API_CALLS", "500"))      # includes retries
+CHECKPOINT_EVERY = int(os.getenv("CHECKPOINT_EVERY", "20"))    # enriched rows between checkpoints
+
+# concurrent runs: "slice" takes unclaimed matches, "exit" leaves it to the live run
+COALESCE_MODE = os.getenv("COALESCE_MODE", "slice")
+SLICE_SIZE    = int(os.getenv("SLICE_SIZE", str(MAX_API_CALLS)))  # matches claimed per run
+LEASE_TTL_SEC = float(os.getenv("LEASE_TTL_SEC", str(RUN_BUDGET_SEC + 60)))  # claim outlives the run
+
+# matches that fail (all retries, or the hour missing) are retried after fresh ones
+MAX_MATCH_ATTEMPTS = int(os.getenv("MAX_MATCH_ATTEMPTS", "3"))    # failed runs before a match is parked
+RETRY_PARKED_DAYS  = float(os.getenv("RETRY_PARKED_DAYS", "7"))   # parked matches get one try per period
+
 # ─── LOGGING SETUP ─────────────────────────────────────────────────────────────
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -53,12 +77,35 @@ def fetch_hourly_archive(lat, lon, date_iso, vars_list, timezone):
     return resp.json()
 
 
-def safe_fetch(lat, lon, date_iso, vars_list, timezone):
+def new_budget():
+    return {"started": time.monotonic(), "api_calls": 0, "quota_hit": False}
+
+
+def budget_exhausted(budget):
+    """Reason the run must stop fetching, or None while budget remains."""
+    elapsed = time.monotonic() - budget["started"]
+    if budget["quota_hit"]:
+        return "API quota exhausted (HTTP 429)"
+    if elapsed >= RUN_BUDGET_SEC - FLUSH_MARGIN_SEC:
+        return f"time budget reached after {elapsed:.0f}s"
+    if budget["api_calls"] >= MAX_API_CALLS:
+        return f"request budget reached after {budget['api_calls']} API calls"
+    return None
+
+
+def safe_fetch(lat, lon, date_iso, vars_list, timezone, budget):
     for attempt in range(1, MAX_RETRIES + 1):
+        if budget_exhausted(budget):
+            return None
+        budget["api_calls"] += 1
         try:
             data = fetch_hourly_archive(lat, lon, date_iso, vars_list, timezone)
             return data
         except requests.exceptions.RequestException as e:
+            if getattr(e.response, "status_code", None) == 429:
+                logger.error(f"Rate limited by the weather API for {lat},{lon} on {date_iso}: {e}")
+                budget["quota_hit"] = True
+                return None
             logger.warning(f"Fetch attempt {attempt} failed for {lat},{lon} on {date_iso}: {e}")
             if attempt < MAX_RETRIES:
                 wait = 2 ** (attempt - 1)
@@ -69,89 +116,191 @@ def safe_fetch(lat, lon, date_iso, vars_list, timezone):
                 return None
 
 
-def parse_dt(date_str, time_str):
-    dt = datetime.datetime.strptime(f"{date_str} {time_str}", "%d/%m/%Y %H:%M")
-    logger.debug(f"Parsed datetime string {date_str} {time_str} into {dt}")
-    return dt
-
-
-def download_csv_from_gcs(blob_path):
+def download_csv_from_gcs(blob_path, columns):
     logger.info(f"Downloading CSV from gs://{BUCKET_NAME}/{blob_path}")
     blob = bucket.blob(blob_path)
     if not blob.exists(client):
         logger.warning(f"Blob not found: {blob_path}")
         return None
-    data = blob.download_as_string()
-    return pd.read_csv(io.StringIO(data.decode("utf-8")))
+    data = blob.download_as_bytes()
+    return schedule_schema.read_frame(data, columns)
 
 
-def upload_df_to_gcs(df, blob_path):
-    logger.info(f"Uploading DataFrame to gs://{BUCKET_NAME}/{blob_path}")
-    blob = bucket.blob(blob_path)
-    if blob.exists(client):
-        logger.info(f"Deleting existing blob before upload: {blob_path}")
-        blob.delete(client)
-    csv_bytes = df.to_csv(index=False).encode("utf-8")
-    blob.upload_from_string(csv_bytes, content_type="text/csv")
+def merge_rows_to_gcs(df_rows, blob_path):
+    """
+    Append `df_rows` whose match_id is not yet in the CSV at `blob_path`.
+    Only the match_id column of the existing file is parsed; its rows stay
+    as bytes. The write is conditional on the generation read, so rows
+    merged by a concurrent invocation are kept. Returns the match_ids now stored.
+    """
+    logger.info(f"Merging {len(df_rows)} rows into gs://{BUCKET_NAME}/{blob_path}")
+    stored = []
+
+    def update(data):
+        ids = (schedule_schema.read_frame(data, ["match_id"])["match_id"]
+               if data else pd.Series(dtype="Int64"))
+        df_add = df_rows[~df_rows["match_id"].isin(ids)]
+        stored[:] = [pd.concat([ids, df_add["match_id"]], ignore_index=True)]
+        return schedule_schema.append_csv_bytes(data, df_add) if len(df_add) else data
+
+    gcs_lease.cas_update(bucket, blob_path, update, "text/csv")
+    return stored[0]
+
+
+def save_checkpoint(records):
+    """Merge this invocation's enriched rows into the shared checkpoint."""
+    ids = merge_rows_to_gcs(
+        pd.DataFrame(records, columns=schedule_schema.ENRICHED_COLS), CHECKPOINT_PATH)
+    logger.info(f"Checkpointed {len(ids)} pending rows to gs://{BUCKET_NAME}/{CHECKPOINT_PATH}")
+
+
+def prune_checkpoint(done_ids):
+    """Drop checkpointed rows that reached the output; delete the checkpoint once empty."""
+    def update(data):
+        if not data:
+            return data
+        df = schedule_schema.read_frame(data, schedule_schema.ENRICHED_COLS)
+        keep = ~df["match_id"].isin(done_ids)
+        if keep.all():
+            return data
+        return schedule_schema.to_csv_bytes(df[keep]) if keep.any() else None
+
+    gcs_lease.cas_update(bucket, CHECKPOINT_PATH, update, "text/csv")
+
+
+def load_failures():
+    """{match_id: {"attempts": failed runs, "last_failed": epoch}} from earlier runs."""
+    data, _ = gcs_lease.read_blob(bucket, FAILURES_PATH)
+    return {int(k): v for k, v in json.loads(data).items()} if data else {}
+
+
+def record_failures(failed_ids, stored_ids):
+    """Count one more failed run for `failed_ids`; forget matches now stored."""
+    def update(data):
+        failures = json.loads(data) if data else {}
+        for mid in failed_ids:
+            entry = failures.setdefault(str(mid), {"attempts": 0})
+            entry["attempts"] += 1
+            entry["last_failed"] = time.time()
+        for mid in stored_ids:
+            failures.pop(str(mid), None)
+        return json.dumps(failures).encode("utf-8") if failures else None
+
+    gcs_lease.cas_update(bucket, FAILURES_PATH, update, "application/json")
+
+
+def stored_match_ids():
+    """match_ids already in the output or the checkpoint, read fresh from GCS."""
+    frames = [download_csv_from_gcs(path, ["match_id"]) for path in (OUTPUT_PATH, CHECKPOINT_PATH)]
+    ids = [df["match_id"] for df in frames if df is not None]
+    return pd.concat(ids, ignore_index=True) if ids else pd.Series(dtype="Int64")
 
 
 def main():
+    budget = new_budget()
+
     # 1) Download schedule
-    df_sched = download_csv_from_gcs(SCHEDULE_PATH)
+    df_sched = download_csv_from_gcs(SCHEDULE_PATH, schedule_schema.SCHEDULE_COLS)
     if df_sched is None:
         logger.error("Schedule file not found; aborting.")
         raise RuntimeError("Schedule file not found in GCS.")
     logger.info(f"Loaded {len(df_sched)} schedule rows.")
 
     # 2) Load existing enriched (explicit check for None)
-    df_old_raw = download_csv_from_gcs(OUTPUT_PATH)
+    df_old_raw = download_csv_from_gcs(OUTPUT_PATH, ["match_id"])  # only the IDs are needed
     if df_old_raw is None:
-        df_old = pd.DataFrame(columns=[*df_sched.columns.tolist(),
-                                       "datetime","temp_C","humidity_%","pressure_hPa",
-                                       "cloudcover_%","rain_mm","wind_m_s"] )
+        df_old = schedule_schema.empty_frame()
         logger.info("No existing enriched file: starting with empty DataFrame.")
     else:
         df_old = df_old_raw
         logger.info(f"Found {len(df_old)} existing enriched rows.")
 
+    # Resume: rows enriched by an interrupted run count as done
+    df_ckpt = download_csv_from_gcs(CHECKPOINT_PATH, schedule_schema.ENRICHED_COLS)
+    if df_ckpt is None:
+        df_ckpt = schedule_schema.empty_frame()
+    else:
+        df_ckpt = df_ckpt[~df_ckpt["match_id"].isin(df_old["match_id"])]
+        logger.info(f"Resuming with {len(df_ckpt)} checkpointed rows.")
+
     # 3) Filter past-or-today matches
     now = datetime.datetime.now()
-    df_sched["dt_obj"] = df_sched.apply(
-        lambda r: parse_dt(r["match_date"], r["match_time"]), axis=1
-    )
+    df_sched["dt_obj"] = schedule_schema.match_datetimes(df_sched)
     df_past = df_sched[df_sched["dt_obj"] <= now]
     logger.info(f"{len(df_past)} matches on or before {now} to process.")
 
     # 4) Skip already fetched
-    done_ids = set(df_old["match_id"].astype(str).tolist())
-    df_new = df_past[~df_past["match_id"].astype(str).isin(done_ids)]
-    logger.info(f"{len(df_new)} new matches to enrich.")
-    if df_new.empty:
+    done = df_past["match_id"].isin(df_old["match_id"]) | df_past["match_id"].isin(df_ckpt["match_id"])
+    df_new = df_past[~done]
+
+    # Matches that failed earlier runs go after fresh ones; after
+    # MAX_MATCH_ATTEMPTS failed runs they wait RETRY_PARKED_DAYS between tries
+    failures = load_failures()
+    attempts = df_new["match_id"].map(lambda m: failures.get(int(m), {}).get("attempts", 0)).astype(int)
+    last_failed = df_new["match_id"].map(lambda m: failures.get(int(m), {}).get("last_failed", 0.0))
+    parked = ((attempts >= MAX_MATCH_ATTEMPTS)
+              & (time.time() - last_failed.astype(float) < RETRY_PARKED_DAYS * 86400))
+    df_new = df_new.assign(attempts=attempts)[~parked].sort_values("attempts", kind="stable")
+    if parked.any():
+        logger.info(f"{parked.sum()} matches failed {MAX_MATCH_ATTEMPTS}+ runs; parked until their retry date.")
+    logger.info(f"{len(df_new)} new matches to enrich ({(df_new['attempts'] > 0).sum()} retries).")
+    if df_new.empty and df_ckpt.empty:
         logger.info("No new matches; exiting.")
         return
 
-    # 5) Batch by season & fetch
-    records = []
-    for season, grp in df_new.groupby("season"):
-        logger.info(f"Processing season {season} with {len(grp)} matches.")
+    # Claim a slice no concurrent invocation is working on
+    run_id = uuid.uuid4().hex
+    pending = [int(m) for m in df_new["match_id"]]
+    claimed = gcs_lease.claim_slice(bucket, LEASE_PATH, run_id, pending, SLICE_SIZE,
+                                    LEASE_TTL_SEC, exclusive=COALESCE_MODE == "exit")
+    if pending and not claimed:
+        logger.info("Another invocation holds every pending match; exiting.")
+        return
+    # Re-read after claiming: an invocation that released its claim just
+    # before ours has already stored its matches
+    df_new = df_new[df_new["match_id"].isin(claimed)]
+    finished = df_new["match_id"].isin(stored_match_ids())
+    if finished.any():
+        logger.info(f"{finished.sum()} claimed matches were stored by another invocation meanwhile.")
+    df_new = df_new[~finished]
+    logger.info(f"Run {run_id} claimed {len(df_new)} matches.")
+    try:
+        enrich_and_upload(df_sched, df_ckpt, df_new, budget)
+    finally:
+        gcs_lease.release(bucket, LEASE_PATH, run_id)
+
+
+def enrich_and_upload(df_sched, df_ckpt, df_new, budget):
+    # 5) Batch by season & fetch, within the run budget
+    records, failed = [], []
+    stop_reason = None
+    for (tries, season), grp in df_new.groupby(["attempts", "season"], observed=True):
+        logger.info(f"Processing season {season} with {len(grp)} matches"
+                    + (f" that failed {tries} earlier runs." if tries else "."))
         for _, row in grp.iterrows():
+            stop_reason = budget_exhausted(budget)
+            if stop_reason:
+                break
             dt      = row["dt_obj"]
             iso_dt  = dt.strftime("%Y-%m-%dT%H:00")
             date_iso= dt.date().isoformat()
             lat, lon= row["latitude"], row["longitude"]
 
             logger.debug(f"Fetching weather for match {row['match_id']} @ {iso_dt}")
-            data = safe_fetch(lat, lon, date_iso, HOURLY_VARS, TIMEZONE)
+            data = safe_fetch(lat, lon, date_iso, HOURLY_VARS, TIMEZONE, budget)
             if not data:
+                if not budget_exhausted(budget):  # not a budget stop: the match itself failed
+                    failed.append(int(row["match_id"]))
                 continue
 
             times = data.get("hourly", {}).get("time", [])
             if iso_dt not in times:
                 logger.warning(f"Hour {iso_dt} not in API response; skipping.")
+                failed.append(int(row["match_id"]))
                 continue
 
             idx = times.index(iso_dt)
-            rec = row.drop(["dt_obj"]).to_dict()
+            rec = row.drop(["dt_obj", "attempts"]).to_dict()
             rec.update({
                 "datetime":   iso_dt,
                 "temp_C":     data["hourly"]["temperature_2m"][idx],
@@ -163,24 +312,37 @@ def main():
             })
             records.append(rec)
             logger.info(f"Weather fetched for match {row['match_id']}")
+            if len(records) % CHECKPOINT_EVERY == 0:
+                save_checkpoint(records)
             time.sleep(PAUSE_SEC)
+        if stop_reason:
+            break
 
-    # 6) Combine, reorder & upload
-    df_new_enriched = pd.DataFrame(records)
-    df_combined = pd.concat([df_old, df_new_enriched], ignore_index=True)
-    schedule_cols = ["season","match_id","city","match_num","venue","match_date","match_time","team1","team2","venue_id","latitude","longitude"]
-    weather_cols  = ["datetime","temp_C","humidity_%","pressure_hPa","cloudcover_%","rain_mm","wind_m_s"]
-    df_combined = df_combined[schedule_cols + weather_cols]
+    if stop_reason:
+        logger.warning(f"Stopping early: {stop_reason}; remaining matches carry over to the next run.")
+    logger.info(f"Fetched weather for {len(records)} matches with {budget['api_calls']} API calls; "
+                f"{len(df_ckpt)} rows resumed from checkpoint.")
 
-    logger.info(f"Uploading total {len(df_combined)} rows to GCS.")
-    upload_df_to_gcs(df_combined, OUTPUT_PATH)
-    logger.info("Upload complete.")
+    # 6) Merge into the output, then drop what landed from the checkpoint
+    df_new_enriched = schedule_schema.append(
+        df_ckpt, pd.DataFrame(records, columns=schedule_schema.ENRICHED_COLS))
+    stored_ids = merge_rows_to_gcs(df_new_enriched, OUTPUT_PATH)
+    logger.info("Frame memory usage:\n" + schedule_schema.memory_report({
+        "schedule": df_sched, "new enriched": df_new_enriched,
+    }))
+    prune_checkpoint(stored_ids)
+    record_failures(failed, stored_ids)
+    if failed:
+        logger.warning(f"{len(failed)} matches failed; they are retried after fresh ones.")
+    logger.info(f"Upload complete: {len(stored_ids)} enriched rows.")
 
 
 # ─── CLOUD FUNCTION ENTRY POINT ────────────────────────────────────────────────
 def fetch_schedule_weather(request: Request):
+    # ?profile=1 (or PROFILE=1) writes a CPU/allocation profile
     try:
-        main()
+        with profiling_hooks.profile("fetch_schedule_weather", profiling_hooks.requested(request)):
+            main()
         return make_response("Weather enrichment completed.", 200)
     except Exception as e:
         logger.exception("Error in weather enrichment")
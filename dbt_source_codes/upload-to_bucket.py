@@ -44,7 +44,8 @@ def upload_file(filename: str):
     print(f"✅ Uploaded {filename}")
 
 
-def main():
+def main() -> int:
+    """Upload new local JSON files; returns how many were uploaded."""
     print("🔍 Local JSON dir is:", LOCAL_JSON_DIR)
     local      = get_local_files()
     print(f"📂 Local files ({len(local)}):", sorted(local)[:10], "…")
@@ -57,18 +58,21 @@ def main():
     
     if not to_upload:
         print("🎉 Nothing to upload, exiting.")
-        return
+        return 0
 
+    uploaded = 0
     with ThreadPoolExecutor(max_workers=8) as pool:
         futures = { pool.submit(upload_file, fn): fn for fn in to_upload }
         for fut in as_completed(futures):
             fn = futures[fut]
             try:
                 fut.result()
+                uploaded += 1
             except Exception as e:
                 print(f"❌ Error uploading {fn}: {e}")
 
     print("✅ All done.")
+    return uploaded
 
 
 if __name__ == "__main__":